@@ -0,0 +1,27 @@
+import os
+import sys
+import asyncio
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from meesee import Meesee  # noqa: E402
+
+
+box = Meesee()
+
+
+@box.worker(concurrency=50, batch_size=50)
+async def fetch(item, worker_id):
+    await asyncio.sleep(0.1)  # Waiting on an HTTP call or a database
+    print('func: fetch, worker_id: {}, item: {}'.format(worker_id, item))
+
+
+@box.produce()
+def produce_to_fetch(amount):
+    for i in range(amount):
+        yield {"url": "https://example.com/{}".format(i)}
+
+
+if __name__ == '__main__':
+    produce_to_fetch(500)
+    box.push_button(workers=2, wait=1)
@@ -0,0 +1,25 @@
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from meesee import Meesee  # noqa: E402
+
+
+box = Meesee()
+
+
+@box.batch_worker(max_batch=50, max_wait_ms=20)
+def rows(items, worker_id):
+    print('func: rows, worker_id: {}, batch of {} items, first: {}'.format(worker_id, len(items), items[0]))
+
+
+@box.produce()
+def produce_to_rows(amount):
+    for i in range(amount):
+        yield {"row": i}
+
+
+if __name__ == '__main__':
+    produce_to_rows(200)
+    box.push_button(workers=2, wait=1)
@@ -1,12 +1,52 @@
+import gc
+import os
 import sys
+import math
 import time
 import json
+import lzma
+import zlib
+import pickle
+import random
+import signal
+import struct
+import socket
+import asyncio
+import threading
 import traceback
+import importlib
 import redis
+import redis.asyncio
 
-from multiprocessing import Pool
+from multiprocessing import Pool, Process, get_context
+from multiprocessing.connection import wait
 
-from functools import wraps
+from collections import deque, namedtuple
+from contextlib import contextmanager
+from queue import SimpleQueue
+from functools import partial, wraps
+from itertools import count, islice
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    import resource
+except ImportError:
+    # Windows has no resource module.
+    resource = None
 
 config = {
     "namespace": "main",
@@ -15,56 +55,728 @@ config = {
     "maxsize": 1000,
 }
 
+# Size check, eviction and push in a single atomic round trip.
+# Behaves as if every item was pushed one by one, popping the head of the list
+# whenever the list was at maxsize.
+SEND_BOUNDED_SCRIPT = """
+local size = redis.call('LLEN', KEYS[1])
+local maxsize = tonumber(ARGV[1])
+local keep = math.min(size + #ARGV - 1, maxsize)
+if size >= maxsize then
+    keep = math.max(size, 1)
+end
+redis.call('RPUSH', KEYS[1], unpack(ARGV, 2))
+redis.call('LTRIM', KEYS[1], -keep, -1)
+return keep
+"""
+
+# Moves the items of a processing list back to the head of the queue, in order,
+# and removes the consumer ARGV[1] from the set of consumers KEYS[4].
+# Does nothing while the heartbeat of the owning worker is alive.
+REQUEUE_SCRIPT = """
+if redis.call('EXISTS', KEYS[3]) == 1 then
+    return 0
+end
+local items = redis.call('LRANGE', KEYS[1], 0, -1)
+for i = #items, 1, -1 do
+    redis.call('LPUSH', KEYS[2], items[i])
+end
+redis.call('DEL', KEYS[1])
+redis.call('SREM', KEYS[4], ARGV[1])
+return #items
+"""
+
+# Connection pools shared by every queue in this process, keyed by pid and redis_config.
+connection_pools = {}
+
+
+def get_connection_pool(redis_config):
+    """Returns the connection pool of this process for redis_config.
+
+    Queues with the same redis_config share one pool instead of opening their own
+    connections. The pid is part of the key, so a forked child builds a new pool
+    instead of reusing the sockets of its parent.
+    """
+    key = (os.getpid(), repr(sorted(redis_config.items())))
+    pool = connection_pools.get(key)
+    if pool is None:
+        # Let the client translate the config (ssl, unix sockets, ...) into a pool.
+        pool = connection_pools[key] = redis.client.Redis(**redis_config).connection_pool
+    return pool
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=connection_pools.clear)
+
+# Moves scheduled items that are due from the sorted set to the end of the list.
+# Members carry a 16 character unique prefix, so equal items can be scheduled twice.
+PROMOTE_SCRIPT = """
+local due = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, tonumber(ARGV[2]))
+if #due == 0 then
+    return 0
+end
+local items = {}
+for i, member in ipairs(due) do
+    items[i] = string.sub(member, 17)
+end
+redis.call('RPUSH', KEYS[2], unpack(items))
+redis.call('ZREM', KEYS[1], unpack(due))
+return #due
+"""
+
+
+def chunked(iterable, size):
+    """Yields lists of up to size items of iterable.
+
+    When iterable raises, the items taken so far are yielded before the error propagates.
+    """
+    iterator = iter(iterable)
+    while True:
+        chunk = []
+        try:
+            for item in islice(iterator, size):
+                chunk.append(item)
+        except Exception:
+            if chunk:
+                yield chunk
+            raise
+        if not chunk:
+            return
+        yield chunk
+
+
+def as_bytes(item):
+    if isinstance(item, bytes):
+        return item
+    if isinstance(item, (bytearray, memoryview)):
+        return bytes(item)
+    if isinstance(item, str):
+        return item.encode('utf-8')
+    return str(item).encode('utf-8')
+
+
+def as_buffer(item):
+    """Returns bytes-like items in a form redis-py sends without copying them, other items as they are."""
+    if isinstance(item, bytearray):
+        return memoryview(item)
+    if isinstance(item, memoryview) and (item.ndim != 1 or item.format not in 'Bbc'):
+        return item.cast('B') if item.c_contiguous else item.tobytes()
+    return item
+
+
+def encode_item(item):
+    if isinstance(item, (list, dict)):
+        return json.dumps(item)
+    return item
+
+
+def decode_text(payload):
+    return payload.decode('utf-8')
+
+
+def as_is(payload):
+    return payload
+
+
+# loads_batch turns the payloads of a batch into the argument of a batch handler, a list by default.
+Serializer = namedtuple('Serializer', 'dumps loads loads_batch', defaults=(None,))
+
+# The default, lists and dicts are sent as JSON and handlers receive str.
+TEXT = Serializer(encode_item, decode_text)
+
+SERIALIZERS = {
+    'json': Serializer(json.dumps, json.loads),
+    'pickle': Serializer(partial(pickle.dumps, protocol=min(5, pickle.HIGHEST_PROTOCOL)), pickle.loads),
+    'raw': Serializer(as_bytes, as_is),
+}
+if msgpack is not None:
+    SERIALIZERS['msgpack'] = Serializer(msgpack.packb, partial(msgpack.unpackb, raw=False))
+
+
+class NdarrayCodec:
+    """Serializer for numpy arrays, the data follows a header with the dtype and shape.
+
+    The header is padded to 16 bytes, so the data of a payload is aligned.
+    loads returns a copy unless copy is False, then the array is a read only
+    view on the payload. loads_batch stacks the arrays of a batch, which need
+    the same dtype and shape, into one array with the batch as first axis.
+    """
+
+    # ndim, length of the dtype string
+    header = struct.Struct('>BB')
+
+    def __init__(self, copy=True):
+        self.copy = copy
+
+    def dumps(self, array):
+        array = numpy.asarray(array)
+        if array.dtype.hasobject or array.dtype.fields is not None:
+            raise ValueError("the ndarray serializer does not support object or structured arrays")
+        array = numpy.require(array, requirements='C')
+        dtype = array.dtype.str.encode('ascii')
+        shape = struct.pack('>{}Q'.format(array.ndim), *array.shape)
+        header = self.header.pack(array.ndim, len(dtype)) + dtype + shape
+        padding = b'\0' * (-len(header) % 16)
+        return b''.join((header, padding, array.reshape(-1).view(numpy.uint8)))
+
+    def view(self, payload):
+        ndim, size = self.header.unpack_from(payload)
+        start = self.header.size + size
+        dtype = numpy.dtype(bytes(payload[self.header.size:start]).decode('ascii'))
+        shape = struct.unpack_from('>{}Q'.format(ndim), payload, start)
+        offset = start + 8 * ndim
+        offset += -offset % 16
+        return numpy.frombuffer(payload, dtype, count=math.prod(shape), offset=offset).reshape(shape)
+
+    def loads(self, payload):
+        array = self.view(payload)
+        return array.copy() if self.copy else array
+
+    def loads_batch(self, payloads):
+        return numpy.stack([self.view(payload) for payload in payloads])
+
+
+if numpy is not None:
+    SERIALIZERS['ndarray'] = NdarrayCodec()
+
+
+def get_serializer(serializer=None):
+    """Returns the Serializer for a name of SERIALIZERS, TEXT for None, any other object is used as it is."""
+    if serializer is None:
+        return TEXT
+    if not isinstance(serializer, str):
+        return serializer
+    if serializer == 'msgpack' and msgpack is None:
+        raise ValueError("the msgpack serializer needs the msgpack package, pip install msgpack")
+    if serializer == 'ndarray' and numpy is None:
+        raise ValueError("the ndarray serializer needs the numpy package, pip install numpy")
+    if serializer not in SERIALIZERS:
+        raise ValueError("unknown serializer {}, expected one of {}".format(serializer, ', '.join(SERIALIZERS)))
+    return SERIALIZERS[serializer]
+
+
+def worker_loads(config):
+    """Returns the functions that turn a payload, and the payloads of a batch, into handler arguments.
+
+    raw passes the bytes as they are, zero_copy passes ndarray payloads as
+    read only views.
+    """
+    if config.get('raw'):
+        serializer = SERIALIZERS['raw']
+    else:
+        serializer = get_serializer(config.get('serializer'))
+    if config.get('zero_copy'):
+        if not isinstance(serializer, NdarrayCodec):
+            raise ValueError("zero_copy needs the ndarray serializer")
+        serializer = NdarrayCodec(copy=False)
+    loads = serializer.loads
+    return loads, serializer.loads_batch or (lambda payloads: [loads(payload) for payload in payloads])
+
+
+Codec = namedtuple('Codec', 'flag compress decompress')
+
+# The flag is stored in the flags of the Envelope of a compressed item.
+COMPRESSORS = {
+    'zlib': Codec(1, zlib.compress, zlib.decompress),
+    'lzma': Codec(2, lzma.compress, lzma.decompress),
+}
+if zstandard is not None:
+    COMPRESSORS['zstd'] = Codec(3, zstandard.compress, zstandard.decompress)
+COMPRESSION_FLAGS = 0b11
+DECOMPRESSORS = {codec.flag: codec.decompress for codec in COMPRESSORS.values()}
+
+
+def get_compressor(compression):
+    """Returns the Codec for a name of COMPRESSORS, None for None."""
+    if compression is None:
+        return None
+    if compression == 'zstd' and zstandard is None:
+        raise ValueError("zstd compression needs the zstandard package, pip install zstandard")
+    if compression not in COMPRESSORS:
+        raise ValueError("unknown compression {}, expected one of {}".format(compression, ', '.join(COMPRESSORS)))
+    return COMPRESSORS[compression]
+
+
+# Offloaded payloads are stored in a Redis key or a spool file, the item holds the key or path.
+OFFLOAD_REDIS = 0b0100
+OFFLOAD_SPOOL = 0b1000
+OFFLOAD_FLAGS = OFFLOAD_REDIS | OFFLOAD_SPOOL
+OFFLOAD_STORES = {'redis': OFFLOAD_REDIS, 'spool': OFFLOAD_SPOOL}
+
+
+def get_offload_flag(offload):
+    """Returns the flag of an offload store name of OFFLOAD_STORES, None for None."""
+    if offload is None:
+        return None
+    if offload not in OFFLOAD_STORES:
+        raise ValueError("unknown offload {}, expected one of {}".format(offload, ', '.join(OFFLOAD_STORES)))
+    return OFFLOAD_STORES[offload]
+
+
+def open_payload(envelope, payload, queue=None):
+    """Returns payload, claimed from queue when offloaded and decompressed when compressed, by the flags of envelope."""
+    if envelope is None or not envelope.flags:
+        return payload
+    if envelope.flags & OFFLOAD_FLAGS:
+        if queue is None:
+            raise ValueError("item is offloaded, which needs a queue to claim it from")
+        payload = queue.claim(envelope, payload)
+    flag = envelope.flags & COMPRESSION_FLAGS
+    if not flag:
+        return payload
+    if flag not in DECOMPRESSORS:
+        raise ValueError("item is compressed with codec {}, which is not available".format(flag))
+    return DECOMPRESSORS[flag](payload)
+
+
+def strip_envelope(envelope, payload):
+    """Returns payload without envelope, compressed and offloaded payloads keep a new Envelope with just those flags.
+
+    The id is kept, offloaded payloads are found by it.
+    """
+    flags = envelope.flags & (COMPRESSION_FLAGS | OFFLOAD_FLAGS) if envelope is not None else 0
+    return Envelope.new(flags=flags)._replace(id=envelope.id).pack(payload) if flags else payload
+
+
+class Envelope(namedtuple('Envelope', 'id attempts enqueued_at deadline flags')):
+    """Metadata of an item, sent as a fixed size binary header in front of it.
+
+    id is 16 random bytes, enqueued_at and deadline are unix timestamps, a
+    deadline of 0 means none. The low bits of flags name the codec of a
+    compressed payload. Items without the header are plain items, the magic
+    can not start UTF-8 text.
+    """
+    __slots__ = ()
+
+    # magic, version, flags, attempts, enqueued_at, deadline, id
+    header = struct.Struct('>2sBBHdd16s')
+    magic = b'\xa7M'
+    version = 1
+
+    @classmethod
+    def new(cls, attempts=0, deadline=0, flags=0):
+        return cls(os.urandom(16), attempts, time.time(), deadline, flags)
+
+    def pack(self, payload):
+        """Returns payload with this envelope as header, bytes-like payloads are copied once."""
+        header = self.header.pack(self.magic, self.version, self.flags, self.attempts, self.enqueued_at,
+                                  self.deadline, self.id)
+        if not isinstance(payload, (bytes, bytearray, memoryview)):
+            payload = as_bytes(payload)
+        return b''.join((header, payload))
+
+    @classmethod
+    def unpack(cls, item):
+        """Returns the envelope and the payload of item, None and item for plain items.
+
+        Items of an unknown envelope version are returned as they are, they
+        fail in the handler and go through the failure path.
+        """
+        if not item.startswith(cls.magic) or len(item) < cls.header.size:
+            return None, item
+        _, version, flags, attempts, enqueued_at, deadline, item_id = cls.header.unpack_from(item)
+        if version != cls.version:
+            return None, item
+        return cls(item_id, attempts, enqueued_at, deadline, flags), item[cls.header.size:]
+
+
+class QueueBase:
+    """Sending side shared by the queues: maxsize and wrapping items in an Envelope."""
+
+    @property
+    def bounded(self):
+        return self.maxsize is not None and self.maxsize != float('inf')
+
+    def offloads(self, item):
+        """Returns True when item is stored out of band by wrap, see BlockingQueueBase."""
+        return False
+
+    def wrap(self, item, ttl=None):
+        """Returns item in a new Envelope when the queue sends envelopes, item has a ttl or is compressed.
+
+        ttl defaults to the ttl of the queue, workers drop items that are
+        older than ttl seconds. Items of compress_threshold bytes or more are
+        compressed, unless that does not make them smaller.
+        """
+        ttl = self.ttl if ttl is None else ttl
+        deadline = time.time() + ttl if ttl else 0
+        flags = 0
+        sized = isinstance(item, (str, bytes, bytearray, memoryview))
+        if self.compressor is not None and sized and len(item) >= self.compress_threshold:
+            data = as_bytes(item)
+            compressed = self.compressor.compress(data)
+            if len(compressed) < len(data):
+                item, flags = compressed, self.compressor.flag
+        if sized and self.offloads(item):
+            envelope = Envelope.new(deadline=deadline, flags=flags | self.offload_flag)
+            self.offload_payload(envelope.id, item)
+            return envelope.pack(b'')
+        if ttl or flags or self.envelope:
+            return Envelope.new(deadline=deadline, flags=flags).pack(item)
+        return as_buffer(item)
+
+
+class ListQueueBase(QueueBase):
+    """Keys and replies of the queues backed by Redis Lists, RedisQueue and AsyncRedisQueue."""
+
+    def format_list_key(self, namespace, key):
+        return '{}:{}'.format(namespace, key)
+
+    def format_list_keys(self, namespace, key):
+        keys = key if isinstance(key, (list, tuple)) else [key]
+        return [self.format_list_key(namespace, k) for k in keys]
+
+    def ordered_keys(self):
+        """Returns the keys to listen to, in order of priority.
+
+        With weights, the first key is picked at random by weight and the others
+        follow in order of priority, so lower priority keys are not starved.
+        """
+        if self.weights is None or len(self.list_keys) == 1:
+            return self.list_keys
+        first = random.choices(range(len(self.list_keys)), weights=self.weights)[0]
+        return [self.list_keys[first]] + [key for i, key in enumerate(self.list_keys) if i != first]
+
+    def source_key(self, key=None):
+        """Returns the list key an item was taken from, key as returned by Redis, list_key when None."""
+        if key is None:
+            return self.list_key
+        return key.decode('utf-8') if isinstance(key, bytes) else key
+
+    def format_expired_key(self):
+        return '{}:expired'.format(self.list_key)
+
+    def group_by_key(self, pairs):
+        """Returns the items of pairs and of the buffer by their source key, and empties the buffer."""
+        grouped = {}
+        for key, item in [*pairs, *self.buffer]:
+            grouped.setdefault(self.source_key(key), []).append(item)
+        self.buffer.clear()
+        return grouped
+
+    def parse_batch(self, results, count, keys=None):
+        """Returns the (key, item) pairs of the replies of pop_batch."""
+        if len(keys or self.list_keys) > 1 and count > 1:
+            key, items = results[0] or (self.list_key, [])
+            return [(key, item) for item in items]
+        first, *rest = results
+        key = first[0] if first is not None else self.list_key
+        batch = [first] if first is not None else []
+        for items in rest:
+            batch.extend((key, item) for item in items or [])
+        return batch
+
+    def drain(self):
+        """Returns and forgets the fetched items that have not been handed out yet."""
+        items = [item for _, item in self.buffer]
+        self.buffer.clear()
+        return items
+
+
+class BlockingQueueBase(QueueBase):
+    """Offloading and expired items of the queues on the blocking client, RedisQueue and StreamQueue."""
+
+    def offloads(self, item):
+        return self.offload_flag is not None and len(item) >= self.offload_threshold
+
+    def format_blob_key(self, blob_id):
+        # Per namespace, items can be sent to, and requeued on, other keys.
+        return '{}:blob:{}'.format(self.namespace, blob_id.hex())
+
+    def format_spool_path(self, blob_id):
+        return os.path.join(self.spool_dir, blob_id.hex())
+
+    def offload_payload(self, blob_id, item):
+        """Stores item out of band, in a Redis key with offload_ttl or a spool file, under blob_id.
+
+        The item only holds the Envelope, the id of which names the key or
+        file. The spool only works for producers and workers on the same
+        host, /dev/shm keeps it in memory.
+        """
+        data = as_bytes(item) if isinstance(item, str) else item
+        if self.offload_flag == OFFLOAD_SPOOL:
+            os.makedirs(self.spool_dir, exist_ok=True)
+            with open(self.format_spool_path(blob_id), 'wb') as f:
+                f.write(data)
+            if time.monotonic() >= self.next_sweep:
+                self.sweep_spool()
+        else:
+            self.r.set(self.format_blob_key(blob_id), as_buffer(data), ex=self.offload_ttl)
+
+    def sweep_spool(self):
+        """Removes spool files older than offload_ttl, like Redis expires offloaded keys.
+
+        Producers sweep every tenth of offload_ttl. This frees the payloads of
+        items that are never handled, like items evicted by maxsize.
+        """
+        self.next_sweep = time.monotonic() + self.offload_ttl / 10
+        expired = time.time() - self.offload_ttl
+        for entry in os.scandir(self.spool_dir):
+            try:
+                if entry.stat().st_mtime < expired:
+                    os.remove(entry.path)
+            except OSError:
+                pass
+
+    def claim(self, envelope, payload):
+        """Returns the offloaded payload of the item with envelope, stored under its id."""
+        if payload:
+            raise ValueError("offloaded items carry only their envelope, got a payload of {} bytes".format(
+                len(payload)))
+        if envelope.flags & OFFLOAD_SPOOL:
+            with open(self.format_spool_path(envelope.id), 'rb') as f:
+                return f.read()
+        payload = self.r.get(self.format_blob_key(envelope.id))
+        if payload is None:
+            raise ValueError("offloaded payload {} has expired".format(envelope.id.hex()))
+        return payload
+
+    def release(self, item):
+        """Frees the offloaded payloads of item, or of the items of a batch, once handled.
+
+        Freeing is best effort, Redis keys left behind expire after offload_ttl.
+        """
+        keys = []
+        for i in item if isinstance(item, list) else [item]:
+            if not i.startswith(Envelope.magic):
+                continue
+            envelope, _ = Envelope.unpack(i)
+            if envelope is None or not envelope.flags & OFFLOAD_FLAGS:
+                continue
+            if envelope.flags & OFFLOAD_SPOOL:
+                try:
+                    os.remove(self.format_spool_path(envelope.id))
+                except OSError:
+                    pass
+            else:
+                keys.append(self.format_blob_key(envelope.id))
+        if keys:
+            try:
+                self.r.delete(*keys)
+            except redis.RedisError:
+                pass
+
+    def add_expired(self, items, count):
+        """Adds count to {expired_key}:count and items, the expired items kept, to the expired list."""
+        expired_key = self.format_expired_key()
+        with self.r.pipeline(transaction=False) as pipe:
+            pipe.incrby('{}:count'.format(expired_key), count)
+            if items:
+                pipe.rpush(expired_key, *items)
+            pipe.execute()
 
-class RedisQueue:
 
-    def __init__(self, namespace, key, redis_config, maxsize=None, timeout=None):
+class RedisQueue(BlockingQueueBase, ListQueueBase):
+
+    def __init__(self, namespace, key, redis_config, maxsize=None, timeout=None, batch_size=None,
+                 reliable=False, heartbeat_ttl=60, promote_interval=None, promote_batch=1000, weights=None,
+                 envelope=False, ttl=None, serializer=None, compression=None, compress_threshold=1024,
+                 offload=None, offload_threshold=512 * 1024, offload_ttl=86400, spool_dir='/dev/shm/meesee'):
         # TCP check if connection is alive
         # redis_config.setdefault('socket_timeout', 30)
         # redis_config.setdefault('socket_keepalive', True)
         # Ping check if connection is alive
         # redis_config.setdefault('health_check_interval', 30)
-        self.r = redis.Redis(**redis_config)
+        self.r = redis.Redis(connection_pool=get_connection_pool(redis_config))
         self.key = key
         self.namespace = namespace
         self.maxsize = maxsize
         self.timeout = timeout
-        self.list_key = self.format_list_key(namespace, key)
+        self.batch_size = batch_size
+        self.buffer = deque()
+        self.reliable = reliable
+        self.heartbeat_ttl = heartbeat_ttl
+        self.consumer = '{}:{}'.format(socket.gethostname(), os.getpid())
+        self.next_reap = 0
+        self.promote_interval = promote_interval
+        self.promote_batch = promote_batch
+        self.next_promote = 0
+        self.weights = weights
+        self.envelope = envelope
+        self.ttl = ttl
+        self.serializer = get_serializer(serializer)
+        self.compressor = get_compressor(compression)
+        self.compress_threshold = compress_threshold
+        self.offload_flag = get_offload_flag(offload)
+        self.offload_threshold = offload_threshold
+        self.offload_ttl = offload_ttl
+        self.spool_dir = spool_dir
+        self.next_sweep = 0
+        # key can be a list of keys in order of priority, list_key is the first of them.
+        self.list_keys = self.format_list_keys(namespace, key)
+        self.list_key = self.list_keys[0]
+        if reliable and len(self.list_keys) > 1:
+            raise ValueError("reliable mode listens to a single key, got {}".format(key))
+        self.send_bounded = self.r.register_script(SEND_BOUNDED_SCRIPT)
+        self.requeue = self.r.register_script(REQUEUE_SCRIPT)
+        self.promote = self.r.register_script(PROMOTE_SCRIPT)
 
-    def format_list_key(self, namespace, key):
-        return '{}:{}'.format(namespace, key)
+    def format_processing_key(self, consumer):
+        return '{}:processing:{}'.format(self.list_key, consumer)
+
+    def format_heartbeat_key(self, consumer):
+        return '{}:heartbeat:{}'.format(self.list_key, consumer)
+
+    def format_consumers_key(self):
+        return '{}:consumers'.format(self.list_key)
+
+    def format_delayed_key(self, key=None):
+        return '{}:delayed'.format(self.source_key(key))
+
+    def format_dead_key(self, key=None):
+        return '{}:dead'.format(self.source_key(key))
 
     def set_list_key(self, key=None, namespace=None):
         if key is not None:
             self.key = key
         if namespace is not None:
             self.namespace = namespace
-        self.list_key = self.format_list_key(self.namespace, self.key)
+        self.list_keys = self.format_list_keys(self.namespace, self.key)
+        self.list_key = self.list_keys[0]
 
-    def first_inline_send(self, item):
+    def first_inline_send(self, *items):
         # TODO rename method
-        self.r.lpush(self.list_key, item)
+        # Items end up at the head of the list in the given order.
+        self.r.lpush(self.list_key, *reversed(items))
+
+    def push_back(self, pairs=()):
+        """Pushes (key, item) pairs, then the buffered items, back to the head of the keys they were taken from.
+
+        Items keep their order per key, every key is pushed in the same round trip.
+        Returns the amount of items pushed back.
+        """
+        grouped = self.group_by_key(pairs)
+        if grouped:
+            with self.r.pipeline(transaction=False) as pipe:
+                for key, items in grouped.items():
+                    pipe.lpush(key, *reversed(items))
+                pipe.execute()
+        return sum(len(items) for items in grouped.values())
 
-    def send_to(self, key, item):
-        self.r.rpush('{}:{}'.format(self.namespace, key), item)
+    def send_to(self, key, item, ttl=None):
+        self.r.rpush('{}:{}'.format(self.namespace, key), self.wrap(item, ttl))
 
-    def send(self, item):
+    def send(self, item, ttl=None):
         """Adds item to the end of the Redis List.
 
         Side-effects:
            If size is above max size, the operation will keep the size the same.
            Note that if does not resize the list to maxsize.
+
+        The size check, eviction and push are done by a server side script,
+        one round trip per item and the bound holds under concurrent producers.
         """
-        if self.maxsize is not None and len(self) >= self.maxsize:
-            self.r.lpop(self.list_key)
-        self.r.rpush(self.list_key, item)
+        item = self.wrap(item, ttl)
+        if not self.bounded:
+            return self.r.rpush(self.list_key, item)
+        return self.send_bounded(keys=[self.list_key], args=[self.maxsize, item])
+
+    def send_many(self, items, chunk_size=1000, pipeline_chunks=10, ttl=None):
+        """Adds all items to the end of the Redis List.
+
+        The iterable is consumed lazily in chunks of chunk_size items, each chunk
+        is a single multi value push. Chunks are sent over a pipeline that is
+        flushed every pipeline_chunks chunks.
+        Bounded queues apply the same maxsize policy as send, per chunk.
+        chunk_size should stay below 8000, the maximum Lua unpack size.
+        When items raises, the items taken before are still sent.
+
+        Returns the amount of items sent.
+        """
+        sent = 0
+        with self.r.pipeline(transaction=False) as pipe:
+            try:
+                for n, chunk in enumerate(chunked(items, chunk_size), 1):
+                    chunk = [self.wrap(item, ttl) for item in chunk]
+                    if self.bounded:
+                        self.send_bounded(keys=[self.list_key], args=[self.maxsize, *chunk], client=pipe)
+                    else:
+                        pipe.rpush(self.list_key, *chunk)
+                    sent += len(chunk)
+                    if n % pipeline_chunks == 0:
+                        pipe.execute()
+            finally:
+                pipe.execute()
+        return sent
+
+    def send_at(self, item, timestamp, wrapped=False, key=None):
+        """Schedules item to be added to the end of the Redis List at timestamp.
+
+        Scheduled items wait in a sorted set. Workers of the queue with
+        promote_interval set move the due items to the list, in bulk.
+        wrapped items, like retries, already have their Envelope and are sent as they are.
+        key is the priority key to add item to, list_key by default.
+        """
+        # The ttl of the queue would count from scheduling, not from the moment the item is due.
+        item = item if wrapped else self.wrap(item, ttl=0)
+        member = os.urandom(8).hex().encode() + as_bytes(item)
+        return self.r.zadd(self.format_delayed_key(key), {member: timestamp})
+
+    def send_in(self, item, seconds, wrapped=False, key=None):
+        """Schedules item to be added to the end of the Redis List in seconds."""
+        return self.send_at(item, time.time() + seconds, wrapped, key)
+
+    def send_dead(self, item, key=None):
+        """Adds item to the end of the dead letter list of key, list_key by default."""
+        return self.r.rpush(self.format_dead_key(key), item)
+
+    def requeue_dead(self, count=None, chunk_size=1000):
+        """Moves up to count items, all by default, from the dead letter list to the end of the queue.
+
+        Every item is moved by its own LMOVE, chunk_size of them per pipeline
+        round trip, so an interrupted requeue neither loses nor duplicates items.
+        maxsize is not applied. Returns the amount of items moved.
+        """
+        dead_key = self.format_dead_key()
+        count = self.r.llen(dead_key) if count is None else count
+        moved = 0
+        with self.r.pipeline(transaction=False) as pipe:
+            while moved < count:
+                size = min(chunk_size, count - moved)
+                for _ in range(size):
+                    pipe.lmove(dead_key, self.list_key, 'LEFT', 'RIGHT')
+                done = sum(result is not None for result in pipe.execute())
+                moved += done
+                if done < size:
+                    break
+        return moved
+
+    def promote_due(self):
+        """Moves up to promote_batch due scheduled items of every key to its list, returns the amount."""
+        with self.r.pipeline(transaction=False) as pipe:
+            self.add_promotes(pipe)
+            return sum(pipe.execute())
+
+    def add_promotes(self, pipe):
+        """Adds promoting the due items of every key to pipe, returns the amount of commands added."""
+        for list_key in self.list_keys:
+            self.promote(keys=[self.format_delayed_key(list_key), list_key], args=[time.time(), self.promote_batch],
+                         client=pipe)
+        return len(self.list_keys)
+
+    def add_promote(self, pipe):
+        """Adds promoting due items to pipe when promote_interval has passed since the last time.
+
+        Returns the amount of commands added.
+        """
+        if self.promote_interval is None or time.monotonic() < self.next_promote:
+            return 0
+        return self.add_promotes(pipe)
+
+    def promoted(self, results, commands):
+        """Takes the replies of the commands added by add_promote off the front of results."""
+        amounts = results[:commands]
+        del results[:commands]
+        # A full batch means more items are probably due already.
+        wait = 0 if max(amounts) >= self.promote_batch else self.promote_interval
+        self.next_promote = time.monotonic() + wait
 
     def send_unsafe(self, item):
         """Adds item to the end of the Redis List.
         Because there is no limit enforcement, this could completely fill the redis queue.
         Causing issues down the line.
         """
-        self.r.rpush(self.list_key, item)
+        self.r.rpush(self.list_key, self.wrap(item))
 
     def send_wait(self, item):
         """Adds item to the end of the Redis List.
@@ -73,23 +785,625 @@ class RedisQueue:
         """
         while self.maxsize is not None and self.r.llen(self.list_key) >= self.maxsize:
             time.sleep(1)
-        self.r.rpush(self.list_key, item)
+        self.r.rpush(self.list_key, self.wrap(item))
 
     def send_dict(self, item):
-        self.send(json.dumps(item))
+        self.send(self.serializer.dumps(item))
 
     def __iter__(self):
         return self
 
     def __next__(self):
-        result = self.r.blpop(self.list_key, self.timeout)
-        if result is None:
+        if self.buffer:
+            return self.buffer.popleft()
+        if self.reliable:
+            return self.next_reliable()
+        if (self.batch_size is None or self.batch_size <= 1) and self.promote_interval is None:
+            result = self.r.blpop(self.ordered_keys(), self.timeout)
+            if result is None:
+                raise StopIteration
+            return result
+        self.buffer.extend(self.fetch_batch())
+        if not self.buffer:
             raise StopIteration
-        return result
+        return self.buffer.popleft()
+
+    def next_reliable(self):
+        """Returns the next item, moved into the processing list of this consumer.
+
+        With batch_size, up to batch_size - 1 more items are moved in the same
+        round trip and buffered, they are in the processing list as well.
+        """
+        items = self.move_batch(self.batch_size or 1)
+        if not items:
+            raise StopIteration
+        self.buffer.extend((self.list_key, item) for item in items[1:])
+        return self.list_key, items[0]
+
+    def move_batch(self, count, timeout=None):
+        """Atomically moves up to count items into the processing list of this consumer.
+
+        The items stay there until ack, so they survive a hard crash of the worker.
+        BLMOVE blocks for the first item, the LMOVEs for the others are queued
+        behind it, the heartbeat is refreshed and the consumer registered in the
+        same round trip. timeout defaults to the timeout of the queue.
+        Blocking is capped at heartbeat_ttl so stale processing lists get reaped
+        while idle. heartbeat_ttl has to exceed the longest handler run.
+        Due scheduled items are promoted in the same round trip.
+        An empty list means the timeout was reached.
+        """
+        processing_key = self.format_processing_key(self.consumer)
+        heartbeat_key = self.format_heartbeat_key(self.consumer)
+        timeout = self.timeout if timeout is None else timeout
+        deadline = time.monotonic() + timeout if timeout else None
+        while True:
+            now = time.monotonic()
+            if now >= self.next_reap:
+                self.reap()
+                self.next_reap = now + self.heartbeat_ttl
+            wait = min(self.heartbeat_ttl, self.promote_interval or self.heartbeat_ttl)
+            if deadline is not None:
+                wait = min(wait, deadline - now)
+            if wait < 0.001:
+                return []
+            with self.r.pipeline(transaction=False) as pipe:
+                promote = self.add_promote(pipe)
+                pipe.sadd(self.format_consumers_key(), self.consumer)
+                pipe.set(heartbeat_key, 1, ex=self.heartbeat_ttl)
+                pipe.blmove(self.list_key, processing_key, wait, 'LEFT', 'RIGHT')
+                for _ in range(count - 1):
+                    pipe.lmove(self.list_key, processing_key, 'LEFT', 'RIGHT')
+                results = pipe.execute()
+            if promote:
+                self.promoted(results, promote)
+            items = [item for item in results[2:] if item is not None]
+            if items:
+                return items
+
+    def ack(self, item):
+        """Removes a handled item, or the items of a batch, from the processing list of this consumer."""
+        processing_key = self.format_processing_key(self.consumer)
+        if not isinstance(item, list):
+            self.r.lrem(processing_key, 1, item)
+            return
+        with self.r.pipeline(transaction=False) as pipe:
+            for i in item:
+                pipe.lrem(processing_key, 1, i)
+            pipe.execute()
+
+    def requeue_processing(self):
+        """Moves the in-flight items of this consumer back to the head of the queue."""
+        self.r.delete(self.format_heartbeat_key(self.consumer))
+        return self.requeue(keys=[
+            self.format_processing_key(self.consumer),
+            self.list_key,
+            self.format_heartbeat_key(self.consumer),
+            self.format_consumers_key(),
+        ], args=[self.consumer])
+
+    def reap(self):
+        """Requeues the items of processing lists whose worker stopped sending heartbeats.
+
+        Consumers register in a set on every fetch, so only their processing
+        lists are looked at, instead of scanning the keyspace.
+        Returns the amount of items requeued.
+        """
+        consumers = self.r.smembers(self.format_consumers_key())
+        if not consumers:
+            return 0
+        with self.r.pipeline(transaction=False) as pipe:
+            for consumer in consumers:
+                if isinstance(consumer, bytes):
+                    consumer = consumer.decode('utf-8')
+                keys = [self.format_processing_key(consumer), self.list_key, self.format_heartbeat_key(consumer),
+                        self.format_consumers_key()]
+                self.requeue(keys=keys, args=[consumer], client=pipe)
+            return sum(pipe.execute())
+
+    def fetch_batch(self, count=None, timeout=None, keys=None):
+        """Blocks for the first item, then takes up to count - 1 more.
+
+        count defaults to batch_size and timeout to the timeout of the queue,
+        keys to every key in order of priority.
+        With promote_interval set, blocking is capped at promote_interval, so
+        due scheduled items get promoted while the queue is idle.
+        In reliable mode the items are moved into the processing list instead.
+        """
+        count = (self.batch_size or 1) if count is None else count
+        timeout = self.timeout if timeout is None else timeout
+        if self.reliable:
+            return [(self.list_key, item) for item in self.move_batch(count, timeout)]
+        if self.promote_interval is None:
+            return self.pop_batch(count, timeout, keys)
+        deadline = time.monotonic() + timeout if timeout else None
+        while True:
+            wait = self.promote_interval
+            if deadline is not None:
+                wait = min(wait, deadline - time.monotonic())
+            if wait < 0.001:
+                return []
+            batch = self.pop_batch(count, wait, keys)
+            if batch:
+                return batch
+
+    def pop_batch(self, count, timeout, keys=None):
+        """Pops up to count items, blocking at most timeout for the first.
+
+        All commands are sent in one pipeline, the LPOP is queued behind the
+        BLPOP on the server, so the whole batch costs a single round trip.
+        With several keys BLMPOP takes the batch from the first non-empty key.
+        """
+        keys = self.ordered_keys() if keys is None else keys
+        with self.r.pipeline(transaction=False) as pipe:
+            promote = self.add_promote(pipe)
+            if len(keys) > 1 and count > 1:
+                pipe.blmpop(timeout or 0, len(keys), *keys, direction='LEFT', count=count)
+            else:
+                pipe.blpop(keys, timeout)
+                if count > 1:
+                    pipe.lpop(keys[0], count - 1)
+            results = pipe.execute()
+        if promote:
+            self.promoted(results, promote)
+        return self.parse_batch(results, count, keys)
+
+    def get_batch(self, max_batch, max_wait_ms=None):
+        """Returns a list of up to max_batch items, see next_batch."""
+        return self.next_batch(max_batch, max_wait_ms)[1]
+
+    def next_batch(self, max_batch, max_wait_ms=None):
+        """Returns the key and a list of up to max_batch items taken from that key.
+
+        Blocks for the first item, then waits at most max_wait_ms for the
+        batch to fill up from the same key. An empty list means the queue
+        timeout was reached. The batch is collected in the buffer, so drain
+        returns the items fetched so far when the worker is interrupted while
+        it fills up.
+        """
+        if not self.buffer:
+            self.buffer.extend(self.fetch_batch(max_batch))
+        if not self.buffer:
+            return self.list_key, []
+        key = self.buffer[0][0]
+        deadline = time.monotonic() + (max_wait_ms or 0) / 1000
+        while len(self.buffer) < max_batch:
+            remaining = deadline - time.monotonic()
+            # Redis rounds the timeout to milliseconds, zero would block forever.
+            if remaining < 0.001:
+                break
+            more = self.fetch_batch(max_batch - len(self.buffer), timeout=remaining, keys=[key])
+            if not more:
+                break
+            self.buffer.extend(more)
+        batch = []
+        while self.buffer and len(batch) < max_batch and self.buffer[0][0] == key:
+            batch.append(self.buffer.popleft()[1])
+        return key, batch
 
     def __len__(self):
         return self.r.llen(self.list_key)
 
+    def add_len(self, pipe):
+        """Adds the length of every key to pipe, returns the amount of commands added, see parse_len."""
+        for list_key in self.list_keys:
+            pipe.llen(list_key)
+        return len(self.list_keys)
+
+    def parse_len(self, replies):
+        """Returns the length of the queue from the replies of the commands of add_len."""
+        return sum(replies)
+
+    def report_rss(self, rss):
+        """Stores the memory usage of this consumer in MB in the hash {list_key}:rss, None removes it."""
+        if rss is None:
+            self.r.hdel('{}:rss'.format(self.list_key), self.consumer)
+        else:
+            self.r.hset('{}:rss'.format(self.list_key), self.consumer, round(rss, 1))
+
+
+class StreamQueue(BlockingQueueBase):
+    """Redis Stream backed queue with the interface of RedisQueue.
+
+    Entries are read through a consumer group with XREADGROUP, batch_size entries
+    per round trip, and acknowledged with ack. Acknowledgements are sent along with
+    the next read, or once ack_batch of them are waiting.
+    Entries left pending for claim_idle_ms, for instance by a worker that died,
+    are taken over with XAUTOCLAIM, resuming the scan of the pending entries
+    where the previous claim left off.
+    """
+
+    def __init__(self, namespace, key, redis_config, maxsize=None, timeout=None, batch_size=None,
+                 group='meesee', claim_idle_ms=60000, ack_batch=100, envelope=False, ttl=None, serializer=None,
+                 compression=None, compress_threshold=1024, offload=None, offload_threshold=512 * 1024,
+                 offload_ttl=86400, spool_dir='/dev/shm/meesee'):
+        self.r = redis.Redis(connection_pool=get_connection_pool(redis_config))
+        self.key = key
+        self.namespace = namespace
+        self.maxsize = maxsize
+        self.timeout = timeout
+        self.batch_size = batch_size
+        self.group = group
+        self.claim_idle_ms = claim_idle_ms
+        self.ack_batch = ack_batch
+        self.envelope = envelope
+        self.ttl = ttl
+        self.serializer = get_serializer(serializer)
+        self.compressor = get_compressor(compression)
+        self.compress_threshold = compress_threshold
+        self.offload_flag = get_offload_flag(offload)
+        self.offload_threshold = offload_threshold
+        self.offload_ttl = offload_ttl
+        self.spool_dir = spool_dir
+        self.next_sweep = 0
+        self.consumer = '{}:{}'.format(socket.gethostname(), os.getpid())
+        # Entries read but not handed out, and handed out but not acknowledged.
+        self.buffer = deque()
+        self.delivered = deque()
+        self.ack_ids = []
+        self.group_ready = False
+        self.next_claim = 0
+        self.claim_cursor = '0-0'
+        self.stream_key = self.format_stream_key(namespace, key)
+
+    def format_stream_key(self, namespace, key):
+        return '{}:{}'.format(namespace, key)
+
+    def add(self, client, stream_key, item):
+        if self.bounded:
+            return client.xadd(stream_key, {'item': item}, maxlen=self.maxsize, approximate=True)
+        return client.xadd(stream_key, {'item': item})
+
+    def send(self, item, ttl=None):
+        """Adds item to the stream, trimming the stream to about maxsize entries."""
+        return self.add(self.r, self.stream_key, self.wrap(item, ttl))
+
+    def send_to(self, key, item, ttl=None):
+        return self.add(self.r, self.format_stream_key(self.namespace, key), self.wrap(item, ttl))
+
+    def send_dict(self, item):
+        self.send(self.serializer.dumps(item))
+
+    def send_many(self, items, chunk_size=1000, pipeline_chunks=1, ttl=None):
+        """Adds all items to the stream over a pipeline, flushed every pipeline_chunks chunks of chunk_size items.
+
+        When items raises, the items taken before are still sent.
+        """
+        sent = 0
+        with self.r.pipeline(transaction=False) as pipe:
+            try:
+                for n, chunk in enumerate(chunked(items, chunk_size), 1):
+                    for item in chunk:
+                        self.add(pipe, self.stream_key, self.wrap(item, ttl))
+                    sent += len(chunk)
+                    if n % pipeline_chunks == 0:
+                        pipe.execute()
+            finally:
+                pipe.execute()
+        return sent
+
+    def first_inline_send(self, *items):
+        """Adds items to the stream again.
+
+        Streams can only be appended to, the items end up at the end of the stream.
+        The entries they were read from are acknowledged by ack.
+        """
+        with self.r.pipeline() as pipe:
+            for item in items:
+                self.add(pipe, self.stream_key, item)
+            pipe.execute()
+
+    def ack(self, item):
+        """Acknowledges the entry handed out for item, or the entries of the items of a batch.
+
+        Single items are handed out and acknowledged in order, so that is the
+        oldest entry. The items of a batch can be acknowledged apart, the
+        expired ones first, and are looked up among the handed out entries.
+        """
+        if not isinstance(item, list):
+            self.ack_ids.append(self.delivered.popleft()[0])
+        else:
+            for i in item:
+                n = next((n for n, (_, delivered) in enumerate(self.delivered) if delivered == i), 0)
+                self.ack_ids.append(self.delivered[n][0])
+                del self.delivered[n]
+        if len(self.ack_ids) >= self.ack_batch:
+            self.flush_acks()
+
+    def flush_acks(self):
+        if self.ack_ids:
+            self.r.xack(self.stream_key, self.group, *self.ack_ids)
+            self.ack_ids = []
+
+    def requeue_processing(self):
+        """Hands back every entry that was read but not handled, returns the amount."""
+        items = [item for _, item in self.delivered]
+        items.extend(self.drain())
+        if items:
+            self.first_inline_send(*items)
+        self.ack_ids.extend(entry_id for entry_id, _ in self.delivered)
+        self.delivered.clear()
+        self.flush_acks()
+        return len(items)
+
+    def drain(self):
+        """Returns and forgets the entries that have not been handed out yet."""
+        items = [item for _, item in self.buffer]
+        self.delivered.extend(self.buffer)
+        self.buffer.clear()
+        return items
+
+    def create_group(self):
+        try:
+            self.r.xgroup_create(self.stream_key, self.group, id='0', mkstream=True)
+        except redis.ResponseError as e:
+            if 'BUSYGROUP' not in str(e):
+                raise
+        self.group_ready = True
+
+    def claimed(self, reply):
+        """Returns the entries of an XAUTOCLAIM reply, keeping its cursor for the next claim.
+
+        The scan goes on from the cursor, a full scan waits claim_idle_ms for the next.
+        """
+        cursor, entries = reply[:2]
+        self.claim_cursor = '0-0' if cursor in (b'0-0', '0-0') else cursor
+        if self.claim_cursor == '0-0':
+            self.next_claim = time.monotonic() + self.claim_idle_ms / 1000
+        return list(entries)
+
+    def read(self, count=None, timeout=None):
+        """Reads the next entries, claiming stale ones, in a single round trip.
+
+        count defaults to batch_size and timeout to the timeout of the queue.
+        Reads that claim do not block, claimed entries are handed out right away.
+        Only when nothing was claimed or read, the read is repeated blocking.
+        """
+        if not self.group_ready:
+            self.create_group()
+        count = (self.batch_size or 1) if count is None else count
+        timeout = self.timeout if timeout is None else timeout
+        block = 0 if timeout is None else max(int(timeout * 1000), 1)
+        claim = time.monotonic() >= self.next_claim
+        with self.r.pipeline(transaction=False) as pipe:
+            if self.ack_ids:
+                pipe.xack(self.stream_key, self.group, *self.ack_ids)
+            if claim:
+                pipe.xautoclaim(self.stream_key, self.group, self.consumer, self.claim_idle_ms,
+                                start_id=self.claim_cursor, count=count)
+            pipe.xreadgroup(self.group, self.consumer, {self.stream_key: '>'}, count=count,
+                            block=None if claim else block)
+            try:
+                results = pipe.execute()
+            except redis.ResponseError as e:
+                if 'NOGROUP' not in str(e):
+                    raise
+                self.group_ready = False
+                return self.read(count, timeout)
+        if self.ack_ids:
+            results.pop(0)
+            self.ack_ids = []
+        entries = self.claimed(results.pop(0)) if claim else []
+        for _, stream_entries in results[0] or []:
+            entries.extend(stream_entries)
+        # Entries deleted by trimming are claimed without fields.
+        fetched = [(entry_id, fields[b'item']) for entry_id, fields in entries if fields]
+        self.buffer.extend(fetched)
+        if claim and not fetched:
+            self.read(count, timeout)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if not self.buffer:
+            self.read()
+        if not self.buffer:
+            raise StopIteration
+        entry = self.buffer.popleft()
+        self.delivered.append(entry)
+        return self.stream_key, entry[1]
+
+    def get_batch(self, max_batch, max_wait_ms=None):
+        """Returns a list of up to max_batch items, see next_batch."""
+        return self.next_batch(max_batch, max_wait_ms)[1]
+
+    def next_batch(self, max_batch, max_wait_ms=None):
+        """Returns the stream key and a list of up to max_batch entries.
+
+        Blocks for the first entry, then waits at most max_wait_ms for the
+        batch to fill up. An empty list means the queue timeout was reached.
+        The entries are handed out together and acknowledged by ack of the batch.
+        """
+        if not self.buffer:
+            self.read(max_batch)
+        deadline = time.monotonic() + (max_wait_ms or 0) / 1000
+        while self.buffer and len(self.buffer) < max_batch:
+            remaining = deadline - time.monotonic()
+            # XREADGROUP blocks in milliseconds, zero would block forever.
+            if remaining < 0.001:
+                break
+            size = len(self.buffer)
+            self.read(max_batch - size, remaining)
+            if len(self.buffer) == size:
+                break
+        batch = [self.buffer.popleft() for _ in range(min(max_batch, len(self.buffer)))]
+        self.delivered.extend(batch)
+        return self.stream_key, [item for _, item in batch]
+
+    def __len__(self):
+        with self.r.pipeline(transaction=False) as pipe:
+            self.add_len(pipe)
+            return self.parse_len(pipe.execute())
+
+    def add_len(self, pipe):
+        """Adds the commands for the backlog of the group to pipe, returns the amount of commands added."""
+        if not self.group_ready:
+            self.create_group()
+        pipe.xinfo_groups(self.stream_key)
+        pipe.xlen(self.stream_key)
+        return 2
+
+    def parse_len(self, replies):
+        """Returns the backlog of the group, the entries not read yet plus the ones not acknowledged.
+
+        Acknowledged entries stay in the stream until trimmed, so the length of
+        the stream only counts when the lag of the group is unknown, before Redis 7.0.
+        """
+        groups, length = replies
+        group = next((group for group in groups if group['name'] in (self.group, self.group.encode())), None)
+        if group is None or group.get('lag') is None:
+            return length
+        return group['lag'] + group['pending']
+
+    def format_expired_key(self):
+        return '{}:expired'.format(self.stream_key)
+
+    def report_rss(self, rss):
+        """Stores the memory usage of this consumer in MB in the hash {stream_key}:rss, None removes it."""
+        if rss is None:
+            self.r.hdel('{}:rss'.format(self.stream_key), self.consumer)
+        else:
+            self.r.hset('{}:rss'.format(self.stream_key), self.consumer, round(rss, 1))
+
+
+class AsyncRedisQueue(ListQueueBase):
+    """RedisQueue on redis.asyncio, used by run_async_worker.
+
+    Covers list queues with priority keys, maxsize and batch_size. Reliable
+    mode and scheduled items need the blocking RedisQueue.
+    """
+
+    def __init__(self, namespace, key, redis_config, maxsize=None, timeout=None, batch_size=None, weights=None,
+                 envelope=False, ttl=None, serializer=None, compression=None, compress_threshold=1024):
+        self.r = redis.asyncio.Redis(**redis_config)
+        self.key = key
+        self.namespace = namespace
+        self.maxsize = maxsize
+        self.timeout = timeout
+        self.batch_size = batch_size
+        self.weights = weights
+        self.envelope = envelope
+        self.ttl = ttl
+        self.serializer = get_serializer(serializer)
+        self.compressor = get_compressor(compression)
+        self.compress_threshold = compress_threshold
+        self.buffer = deque()
+        self.list_keys = self.format_list_keys(namespace, key)
+        self.list_key = self.list_keys[0]
+        self.send_bounded = self.r.register_script(SEND_BOUNDED_SCRIPT)
+
+    async def push_back(self, pairs=()):
+        """Pushes (key, item) pairs, then the buffered items, back to the keys they were taken from, see RedisQueue."""
+        grouped = self.group_by_key(pairs)
+        if grouped:
+            async with self.r.pipeline(transaction=False) as pipe:
+                for key, items in grouped.items():
+                    pipe.lpush(key, *reversed(items))
+                await pipe.execute()
+        return sum(len(items) for items in grouped.values())
+
+    async def first_inline_send(self, *items):
+        # Items end up at the head of the list in the given order.
+        await self.r.lpush(self.list_key, *reversed(items))
+
+    async def send_to(self, key, item, ttl=None):
+        await self.r.rpush('{}:{}'.format(self.namespace, key), self.wrap(item, ttl))
+
+    async def send(self, item, ttl=None):
+        """Adds item to the end of the Redis List, with the maxsize policy of RedisQueue.send."""
+        item = self.wrap(item, ttl)
+        if not self.bounded:
+            return await self.r.rpush(self.list_key, item)
+        return await self.send_bounded(keys=[self.list_key], args=[self.maxsize, item])
+
+    async def send_many(self, items, chunk_size=1000, ttl=None):
+        """Adds all items to the end of the Redis List, one multi value push per chunk."""
+        sent = 0
+        for chunk in chunked(items, chunk_size):
+            chunk = [self.wrap(item, ttl) for item in chunk]
+            if self.bounded:
+                await self.send_bounded(keys=[self.list_key], args=[self.maxsize, *chunk])
+            else:
+                await self.r.rpush(self.list_key, *chunk)
+            sent += len(chunk)
+        return sent
+
+    async def fetch_batch(self, count=None, timeout=None):
+        """Blocks for the first item, then takes up to count - 1 more in the same round trip."""
+        count = (self.batch_size or 1) if count is None else count
+        timeout = self.timeout if timeout is None else timeout
+        async with self.r.pipeline(transaction=False) as pipe:
+            if len(self.list_keys) > 1 and count > 1:
+                keys = self.ordered_keys()
+                pipe.blmpop(timeout or 0, len(keys), *keys, direction='LEFT', count=count)
+            else:
+                pipe.blpop(self.ordered_keys(), timeout)
+                if count > 1:
+                    pipe.lpop(self.list_key, count - 1)
+            results = await pipe.execute()
+        return self.parse_batch(results, count)
+
+    async def get(self):
+        """Returns the next (key, item), None once the timeout is reached."""
+        if not self.buffer:
+            self.buffer.extend(await self.fetch_batch())
+        return self.buffer.popleft() if self.buffer else None
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        result = await self.get()
+        if result is None:
+            raise StopAsyncIteration
+        return result
+
+    async def length(self):
+        return await self.r.llen(self.list_key)
+
+    async def add_expired(self, items, count):
+        expired_key = self.format_expired_key()
+        async with self.r.pipeline(transaction=False) as pipe:
+            pipe.incrby('{}:count'.format(expired_key), count)
+            if items:
+                pipe.rpush(expired_key, *items)
+            await pipe.execute()
+
+    async def close(self):
+        await self.r.close()
+
+
+# Config keys used by run_worker and not by the queue itself.
+WORKER_OPTIONS = ('max_batch', 'max_wait_ms', 'max_tasks_per_worker', 'max_rss_mb', 'rss_report_interval',
+                  'concurrency', 'threads_per_worker', 'task_timeout', 'max_retries', 'retry_backoff',
+                  'retry_max_backoff', 'dead_letter', 'expired_list', 'raw', 'zero_copy')
+
+
+def queue_config(config):
+    return {key: value for key, value in config.items() if key not in WORKER_OPTIONS}
+
+
+def make_async_queue(config):
+    """Creates the AsyncRedisQueue for a config, other backends and modes have no async version."""
+    config = queue_config(config)
+    if config.pop('backend', 'list') != 'list':
+        raise ValueError("async workers support the list backend only")
+    unsupported = [key for key in ('reliable', 'promote_interval', 'offload') if config.pop(key, None)]
+    if unsupported:
+        raise ValueError("async workers do not support {}".format(', '.join(unsupported)))
+    for key in ('heartbeat_ttl', 'promote_batch', 'offload_threshold', 'offload_ttl', 'spool_dir'):
+        config.pop(key, None)
+    return AsyncRedisQueue(**config)
+
+
+def make_queue(config):
+    """Creates the queue for a config, a StreamQueue for backend "stream" else a RedisQueue."""
+    config = queue_config(config)
+    backend = config.pop('backend', 'list')
+    if backend == 'stream':
+        return StreamQueue(**config)
+    return RedisQueue(**config)
+
 
 class Meesee:
 
@@ -100,12 +1414,15 @@ class Meesee:
         self.queue = queue
         self.redis_config = redis_config
         self._worker_funcs = {}
+        self._queue_configs = {}
 
-    def create_produce_config(self):
+    def create_produce_config(self, queue=None):
+        queue = self.queue if queue is None else queue
         return {
-            "key": self.queue,
+            "key": queue,
             "namespace": self.namespace,
             "redis_config": self.redis_config,
+            **queue_config(self._queue_configs.get(queue, {})),
         }
 
     def worker_producer(self, input_queue=None, output_queue=None):
@@ -114,24 +1431,21 @@ class Meesee:
             @wraps(func)
             def wrapper(*args, **kwargs):
 
-                config = self.create_produce_config()
+                queue = self.queue
                 if output_queue:
-                    config["key"] = output_queue
+                    queue = output_queue
                 elif "produce_to_" in func.__name__:
-                    config["key"] = func.__name__[len("produce_to_"):]
+                    queue = func.__name__[len("produce_to_"):]
 
-                redis_queue = RedisQueue(**config)
+                config = self.create_produce_config(queue)
+                redis_queue = make_queue(config)
                 result = func(*args, **kwargs)
 
+                dumps = get_serializer(config.get('serializer')).dumps
                 if isinstance(result, (list, tuple)):
-                    for item in result:
-                        if isinstance(item, (list, dict)):
-                            item = json.dumps(item)
-                        redis_queue.send(item)
+                    redis_queue.send_many(dumps(item) for item in result)
                 elif result is not None:
-                    if isinstance(result, (list, dict)):
-                        result = json.dumps(result)
-                    redis_queue.send(result)
+                    redis_queue.send(dumps(result))
 
                 return result
             parsed_name = input_queue if input_queue is not None else self.parse_func_name(func)
@@ -143,17 +1457,17 @@ class Meesee:
     def produce(self, queue=None):
         def decorator(func):
             def wrapper(*args, **kwargs):
-                config = self.create_produce_config()
+                key = self.queue
                 if queue:
-                    config["key"] = queue
+                    key = queue
                 if "produce_to_" in func.__name__:
-                    config["key"] = func.__name__[len("produce_to_"):]
-                redis_queue = RedisQueue(**config)
+                    key = func.__name__[len("produce_to_"):]
+                config = self.create_produce_config(key)
+                redis_queue = make_queue(config)
+                dumps = get_serializer(config.get('serializer')).dumps
 
-                for item in func(*args, **kwargs):
-                    if isinstance(item, (list, dict)):
-                        item = json.dumps(item)
-                    redis_queue.send(item)
+                # Every chunk is sent once it is complete, workers do not wait for the whole generator.
+                redis_queue.send_many((dumps(item) for item in func(*args, **kwargs)), pipeline_chunks=1)
 
             return wrapper
         return decorator
@@ -194,17 +1508,24 @@ class Meesee:
         6. "item6" will be sent to the "foo3" queue
 
         Notes:
-        - If an item is a list or dict, it will be JSON-encoded before being sent to the queue.
+        - If an item is a list or dict, it will be JSON-encoded before being sent to the queue,
+          unless the queue has its own serializer.
+        - Queues registered with their own options, such as backend="stream", get their own queue.
         """
         def decorator(func):
             def wrapper(*args, **kwargs):
-                config = self.create_produce_config()
-                redis_queue = RedisQueue(**config)
+                redis_queue = make_queue(self.create_produce_config())
+                queues = {}
 
                 for queue, item in func(*args, **kwargs):
-                    if isinstance(item, (list, dict)):
-                        item = json.dumps(item)
-                    redis_queue.send_to(queue, item)
+                    if queue not in self._queue_configs:
+                        redis_queue.send_to(queue, encode_item(item))
+                        continue
+                    if queue not in queues:
+                        config = self.create_produce_config(queue)
+                        queues[queue] = make_queue(config), get_serializer(config.get('serializer')).dumps
+                    target, dumps = queues[queue]
+                    target.send(dumps(item))
 
             return wrapper
         return decorator
@@ -212,14 +1533,80 @@ class Meesee:
     def parse_func_name(self, func):
         return func.__name__
 
-    def worker(self, queue=None):
+    def parse_queue_name(self, queue, func):
+        if queue is None:
+            return self.parse_func_name(func)
+        # A list of queues in order of priority.
+        if isinstance(queue, list):
+            return tuple(queue)
+        return queue
+
+    def worker(self, queue=None, **options):
+        """
+        Register a worker for a queue.
+
+        Options are added to the config of the queue, for both the workers and
+        the producers of this Meesee instance.
+        queue can be a list of queues in order of priority, each fetch returns the
+        item of the highest priority queue available.
+
+        Example:
+            @box.worker(backend="stream")
+            def resize(item, worker_id):
+                ...
+
+            @box.worker(queue=["urgent", "normal", "bulk"], weights=[8, 3, 1])
+            def handle(item, worker_id):
+                ...
+        """
         def decorator(func):
-            parsed_name = queue if queue is not None else self.parse_func_name(func)
+            parsed_name = self.parse_queue_name(queue, func)
             self._worker_funcs[parsed_name] = func
+            if options:
+                self._queue_configs[parsed_name] = options
             return func
         return decorator
 
+    def batch_worker(self, queue=None, max_batch=100, max_wait_ms=50, **options):
+        """
+        Register a worker that is called with a list of items.
+
+        Blocks for the first item, then collects up to max_batch items or
+        whatever arrived within max_wait_ms. The function is called once per batch
+        as func(items, worker_id). When it fails, on_failure_func receives
+        the whole batch. Options are added to the config of the queue, like
+        with worker.
+
+        Example:
+            @box.batch_worker(max_batch=500, max_wait_ms=20)
+            def insert_rows(items, worker_id):
+                db.insert_many(items)
+        """
+        def decorator(func):
+            parsed_name = self.parse_queue_name(queue, func)
+            self._worker_funcs[parsed_name] = func
+            self._queue_configs[parsed_name] = {"max_batch": max_batch, "max_wait_ms": max_wait_ms, **options}
+            return func
+        return decorator
+
+    def assign_workers(self, workers):
+        """Returns the queue of every worker process to start.
+
+        workers maps queue names to their amount of worker processes, queues
+        that are not in the mapping get a single worker.
+        """
+        unknown = [queue for queue in workers if queue not in self._worker_funcs]
+        if unknown:
+            raise ValueError("No workers have been assigned to queues: {}".format(unknown))
+        return [queue for queue in self._worker_funcs for _ in range(workers.get(queue, 1))]
+
     def start_workers(self, workers=10, config=config):
+        if isinstance(workers, dict):
+            queues = self.assign_workers(workers)
+            funcs = [self._worker_funcs[queue] for queue in queues]
+            startapp(funcs, workers=len(funcs), config=config)
+            return
+
         n_workers = len(self._worker_funcs)
         if n_workers == 0:
             sys.stdout.write("No workers have been assigned with a decorator\n")
@@ -229,27 +1616,331 @@ class Meesee:
 
         startapp(list(self._worker_funcs.values()), workers=workers, config=config)
 
-    def push_button(self, workers=None, wait=None):
+    def push_button(self, workers=None, wait=None, autoscale=None, supervise=False, preload=None,
+                    threads_per_worker=None):
+        """
+        Start the workers of all decorated functions.
+
+        workers is either the total amount of worker processes, divided over the
+        queues in turn, or a mapping of queue names to their amount of workers.
+        autoscale maps queue names to a (minimum, maximum) amount of workers,
+        see Supervisor. supervise keeps the amount of workers fixed, but restarts
+        crashed workers. preload is a list of modules to import once before the
+        workers are forked, see preload_app. threads_per_worker runs every
+        worker process with that many threads, it can also be set per queue.
+
+        Example:
+            box.push_button(workers={"resize": 12, "email": 2})
+            box.push_button(autoscale={"resize": (2, 32)})
+        """
         if workers is not None:
             self.workers = workers
-        configs = [
-            {
+        configs = {
+            queue: {
                 "key": queue,
                 "namespace": self.namespace,
                 "redis_config": self.redis_config,
+                **self._queue_configs.get(queue, {}),
             } for queue in self._worker_funcs.keys()
-        ]
+        }
         if self.timeout is not None or wait is not None:
-            for config in configs:
+            for config in configs.values():
                 config["timeout"] = self.timeout or wait
 
-        startapp(list(self._worker_funcs.values()), workers=self.workers, config=configs)
+        if isinstance(self.workers, dict):
+            # One entry per worker process, worker_id modulo the length maps every worker to its own entry.
+            queues = self.assign_workers(self.workers)
+            startapp([self._worker_funcs[queue] for queue in queues], workers=len(queues),
+                     config=[configs[queue] for queue in queues], autoscale=autoscale, supervise=supervise,
+                     preload=preload, threads_per_worker=threads_per_worker)
+            return
+
+        startapp(list(self._worker_funcs.values()), workers=self.workers, config=list(configs.values()),
+                 autoscale=autoscale, supervise=supervise, preload=preload, threads_per_worker=threads_per_worker)
 
 
 class InitFail(Exception):
     pass
 
 
+class RetryPolicy:
+    """Decides what happens to the item of a failed task.
+
+    The item is retried up to max_retries times. Retries are scheduled with
+    send_in on the delayed sorted set of the queue, after a random delay of up
+    to backoff * 2 ** attempts seconds, capped at max_backoff. Items that are
+    not retried go to the dead letter list of the queue with dead_letter, and
+    are dropped otherwise. The attempts travel in the Envelope of the item.
+    """
+
+    def __init__(self, max_retries=None, backoff=1, max_backoff=300, dead_letter=False):
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.dead_letter = dead_letter
+
+    @property
+    def enabled(self):
+        return bool(self.max_retries or self.dead_letter)
+
+    def delay(self, attempts):
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempts))
+
+    def failed(self, r, item, key=None):
+        """Retries, buries or drops item, or every item of a batch, taken from key.
+
+        Retries and dead letters go to the delayed set and the dead letter list
+        of key, so they stay at the priority they were sent with.
+        The offloaded payloads of dropped items are freed.
+        """
+        if not self.enabled:
+            r.release(item)
+            return
+        dropped = []
+        for i in item if isinstance(item, list) else [item]:
+            envelope, payload = Envelope.unpack(i)
+            envelope = envelope or Envelope.new()
+            if self.max_retries and envelope.attempts < self.max_retries:
+                retried = envelope._replace(attempts=envelope.attempts + 1).pack(payload)
+                r.send_in(retried, self.delay(envelope.attempts), wrapped=True, key=key)
+            elif self.dead_letter:
+                r.send_dead(strip_envelope(envelope, payload), key=key)
+            else:
+                dropped.append(i)
+        if dropped:
+            r.release(dropped)
+
+
+def retry_policy(config):
+    """Returns the RetryPolicy of a config, retried items need promote_interval to come back."""
+    policy = RetryPolicy(config.get('max_retries'), config.get('retry_backoff', 1),
+                         config.get('retry_max_backoff', 300), config.get('dead_letter', False))
+    if policy.enabled and config.get('backend') == 'stream':
+        raise ValueError("retries and dead letters need the list backend")
+    if policy.max_retries and config.get('promote_interval') is None:
+        config = {**config, 'promote_interval': 1}
+    return policy, config
+
+
+def open_item(item, queue=None):
+    """Returns the payload and Envelope of item, or the payloads and envelopes of a batch.
+
+    Offloaded payloads are claimed from queue.
+    """
+    if isinstance(item, list):
+        opened = [Envelope.unpack(i) for i in item]
+        return ([open_payload(envelope, payload, queue) for envelope, payload in opened],
+                [envelope for envelope, _ in opened])
+    envelope, payload = Envelope.unpack(item)
+    return open_payload(envelope, payload, queue), envelope
+
+
+def failed_payload(item, queue=None):
+    """Returns the payload of item, or the payloads of a batch, for the failure handler.
+
+    Payloads that can not be claimed or decompressed are passed as they are.
+    """
+    try:
+        return open_item(item, queue)[0]
+    except Exception:
+        if isinstance(item, list):
+            return [Envelope.unpack(i)[1] for i in item]
+        return Envelope.unpack(item)[1]
+
+
+def handler_kwargs(func_kwargs, envelope, pass_envelope):
+    """Returns the keyword arguments of a handler, with envelope when the queue passes envelopes."""
+    return {**func_kwargs, 'envelope': envelope} if pass_envelope else func_kwargs
+
+
+class Expiry:
+    """Drops items whose deadline has passed before they reach the handler.
+
+    Dropped items are counted in {expired_key}:count of the queue, with keep
+    their payloads are added to the expired list as well. Both are written in
+    one round trip per flush, every batch_size dropped items, before the next
+    live item is handled and when the worker stops.
+    """
+
+    def __init__(self, keep=False, batch_size=1000):
+        self.keep = keep
+        self.batch_size = batch_size
+        self.count = 0
+        self.items = []
+        # Dropped items with an offloaded payload, freed on flush.
+        self.offloaded = []
+
+    def expired(self, item):
+        """Returns True, and holds on to the payload of item, when the deadline of its envelope has passed."""
+        envelope, payload = Envelope.unpack(item)
+        if envelope is None or not envelope.deadline or envelope.deadline > time.time():
+            return False
+        self.count += 1
+        if self.keep:
+            self.items.append(strip_envelope(envelope, payload))
+        elif envelope.flags & OFFLOAD_FLAGS:
+            self.offloaded.append(item)
+        return True
+
+    def live(self, item):
+        """Returns item, or the items of a batch, that have not expired, None when nothing is left."""
+        if isinstance(item, list):
+            return [i for i in item if not self.expired(i)] or None
+        return None if self.expired(item) else item
+
+    def dropped(self, item, live):
+        """Returns what live, as returned by live(item), left out of item, None when nothing."""
+        if live is None:
+            return item
+        if not isinstance(item, list) or len(live) == len(item):
+            return None
+        kept = set(live)
+        return [i for i in item if i not in kept]
+
+    def due(self, live):
+        """Returns True when the held items should be written, before handling live or once batch_size are held."""
+        return self.count > 0 and (live is not None or self.count >= self.batch_size)
+
+    def take(self):
+        """Returns the held items and count, and starts over."""
+        pending = self.items, self.count
+        self.items, self.count = [], 0
+        return pending
+
+    def flush(self, r):
+        if self.count:
+            r.add_expired(*self.take())
+        if self.offloaded:
+            r.release(self.offloaded)
+            self.offloaded = []
+
+
+class TaskTimeout(Exception):
+    """Raised in a handler that ran longer than the task_timeout of its queue."""
+
+
+def raise_task_timeout(signum, frame):
+    raise TaskTimeout('task ran longer than its task_timeout')
+
+
+@contextmanager
+def time_limit(seconds):
+    """Raises TaskTimeout in the main thread once the block ran for seconds.
+
+    Uses the real time interval timer, raise_task_timeout has to be the
+    SIGALRM handler. Without seconds the block runs without a limit.
+    """
+    if seconds:
+        signal.setitimer(signal.ITIMER_REAL, seconds)
+    try:
+        yield
+    finally:
+        if seconds:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+
+
+async def wait_limited(awaitable, seconds):
+    """Awaits awaitable, raises TaskTimeout once it ran for seconds."""
+    try:
+        return await asyncio.wait_for(awaitable, seconds)
+    except asyncio.TimeoutError:
+        raise TaskTimeout('task ran longer than its task_timeout') from None
+
+
+def rss_mb():
+    """Returns the resident set size of this process in MB, 0 where it is unknown, on Windows."""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2 ** 20
+    except OSError:
+        if resource is None:
+            return 0.0
+        # Without procfs only the peak is known, in bytes on macOS and KB elsewhere.
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak / 2 ** 20 if sys.platform == 'darwin' else peak / 2 ** 10
+
+
+def private_mb():
+    """Returns the memory only this process uses in MB, pages shared copy-on-write are left out."""
+    try:
+        with open('/proc/self/smaps_rollup') as f:
+            return sum(int(line.split()[1]) for line in f if line.startswith('Private_')) / 2 ** 10
+    except OSError:
+        return rss_mb()
+
+
+class Retired(BaseException):
+    """Raised in a worker waiting for an item when the Supervisor retires it, see Recycler.retire."""
+
+
+class Recycler:
+    """Decides when a worker should stop to be replaced by a fresh process.
+
+    After max_tasks handled tasks, or once the worker uses more than max_rss_mb
+    of memory. With max_rss_mb the memory usage is also reported to the queue
+    every report_interval seconds.
+
+    In the processes of a Supervisor, SIGTERM retires the worker: it stops
+    after the item it is handling, right away when it is waiting for one.
+    """
+
+    # Set by supervised_worker, the Recycler of a supervised worker handles SIGTERM.
+    supervised = False
+
+    def __init__(self, max_tasks=None, max_rss_mb=None, report_interval=10):
+        self.max_tasks = max_tasks
+        self.max_rss_mb = max_rss_mb
+        self.report_interval = report_interval
+        self.tasks = 0
+        self.rss = None
+        self.next_report = 0
+        self.recycle = False
+        self.retired = False
+        self.waiting = False
+        if self.supervised:
+            signal.signal(signal.SIGTERM, self.retire)
+
+    def retire(self, signum=None, frame=None):
+        self.retired = True
+        if self.waiting:
+            raise Retired
+
+    def fetch(self, default, fetch, *args):
+        """Returns fetch(*args), or default once the worker is retired."""
+        if self.retired:
+            return default
+        self.waiting = True
+        try:
+            return fetch(*args)
+        except Retired:
+            return default
+        finally:
+            self.waiting = False
+
+    def fetching(self, queue):
+        """Iterates over queue until the worker is retired."""
+        items = iter(queue)
+        while True:
+            fetched = self.fetch(None, next, items, None)
+            if fetched is None:
+                return
+            yield fetched
+
+    def done(self, r, tasks=1):
+        """Counts handled tasks, returns True once the worker should be recycled or is retired."""
+        self.tasks += tasks
+        if self.max_rss_mb is not None:
+            self.rss = rss_mb()
+            now = time.monotonic()
+            if now >= self.next_report:
+                r.report_rss(self.rss)
+                self.next_report = now + self.report_interval
+            self.recycle = self.rss >= self.max_rss_mb
+        if self.max_tasks is not None and self.tasks >= self.max_tasks:
+            self.recycle = True
+        return self.recycle or self.retired
+
+
 def init_add(func_kwargs, init_items, init_kwargs):
     try:
         for name, config in init_kwargs.items():
@@ -263,45 +1954,696 @@ def setup_init_items(func_kwargs, init_kwargs):
     return {name: func_kwargs[name] for name in init_kwargs.keys()}
 
 
+def preload_app(modules, func_kwargs, shared_kwargs):
+    """Imports modules and creates the shared_kwargs once, in the process that forks the workers.
+
+    shared_kwargs works like init_kwargs, the objects are inherited by every
+    worker instead of created in each of them. gc.freeze keeps the collector
+    of the workers from writing to them, so their pages stay shared.
+    """
+    started = time.monotonic()
+    gc.disable()
+    try:
+        for module in modules:
+            importlib.import_module(module)
+        func_kwargs = init_add(dict(func_kwargs), setup_init_items(func_kwargs, shared_kwargs), shared_kwargs)
+        gc.freeze()
+    finally:
+        gc.enable()
+    sys.stdout.write('preloaded in {seconds:.3f}s, rss {rss:.1f} MB\n'.format(
+        seconds=time.monotonic() - started, rss=rss_mb()))
+    return func_kwargs
+
+
+async def run_async_worker(func, func_kwargs, on_failure_func, config, worker_id, init_kwargs):  # noqa:C901
+    """Runs the coroutine function func on up to concurrency items at once.
+
+    On SIGINT the running handlers are cancelled, their items and the items
+    fetched ahead are pushed back to the head of the queue. When retired by a
+    Supervisor with SIGTERM, the worker stops fetching and lets them finish.
+    """
+    started = time.monotonic()
+    try:
+        func_kwargs = init_add(func_kwargs, setup_init_items(func_kwargs, init_kwargs), init_kwargs)
+    except InitFail:
+        sys.stdout.write('worker {worker_id} initialization failed\n'.format(worker_id=worker_id))
+        traceback.print_exc()
+        return
+    unsupported = [key for key in ('max_batch', 'max_wait_ms', 'max_tasks_per_worker', 'max_rss_mb')
+                   if config.get(key) is not None]
+    if unsupported:
+        raise ValueError("async workers do not support {}".format(', '.join(unsupported)))
+    if RetryPolicy(config.get('max_retries'), dead_letter=config.get('dead_letter', False)).enabled:
+        raise ValueError("async workers do not support retries and dead letters")
+    r = make_async_queue(config)
+    # Failure handlers written for sync workers call the queue without awaiting, they get a RedisQueue.
+    sync_failure = on_failure_func is not None and not asyncio.iscoroutinefunction(on_failure_func)
+    failure_queue = make_queue(config) if sync_failure else r
+    slots = asyncio.Semaphore(config.get('concurrency', 100))
+    in_flight = {}
+    task_timeout = config.get('task_timeout')
+    pass_envelope = config.get('envelope', False)
+    expiry = Expiry(config.get('expired_list', False))
+    loads, loads_batch = worker_loads(config)
+    main = asyncio.current_task()
+    asyncio.get_running_loop().add_signal_handler(signal.SIGINT, main.cancel)
+    retiring, fetching = asyncio.Event(), None
+
+    def retire():
+        retiring.set()
+        if fetching is not None:
+            fetching.cancel()
+
+    if Recycler.supervised:
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, retire)
+
+    async def handle(item):
+        handled = False
+        try:
+            payload, envelope = open_item(item)
+            kwargs = handler_kwargs(func_kwargs, envelope, pass_envelope)
+            await wait_limited(func(loads(payload), worker_id, **kwargs), task_timeout)
+            handled = True
+        except (KeyboardInterrupt, SystemExit):
+            main.cancel()
+        except Exception as e:
+            handled = True
+            sys.stdout.write('worker {worker_id} failed reason {e}\n'.format(worker_id=worker_id, e=e))
+            if on_failure_func is not None:
+                sys.stdout.write('worker {worker_id} running failure handler {e}\n'.format(worker_id=worker_id, e=e))
+                result = on_failure_func(failed_payload(item), e, failure_queue, worker_id)
+                if asyncio.iscoroutine(result):
+                    await result
+        finally:
+            # Items of cancelled and interrupted handlers stay in in_flight, to be pushed back.
+            if handled:
+                del in_flight[asyncio.current_task()]
+                slots.release()
+
+    sys.stdout.write('worker {worker_id} started. {func_name} listening to {queue} \n'.format(
+        worker_id=worker_id, func_name=func.__name__, queue=config["key"]))
+    sys.stdout.write('worker {worker_id} ready in {seconds:.3f}s, private memory {private:.1f} MB\n'.format(
+        worker_id=worker_id, seconds=time.monotonic() - started, private=private_mb()))
+    try:
+        while True:
+            await slots.acquire()
+            if retiring.is_set():
+                break
+            fetching = asyncio.ensure_future(r.get())
+            await asyncio.wait([fetching])
+            if fetching.cancelled():
+                break
+            try:
+                fetched = fetching.result()
+            except Exception as e:
+                # Connections are recovered by the connection pool of the queue.
+                sys.stdout.write('worker {worker_id} failed reason {e}\n'.format(worker_id=worker_id, e=e))
+                slots.release()
+                await asyncio.sleep(0.1)  # Throttle reconnecting
+                continue
+            finally:
+                fetching = None
+            if fetched is None:
+                break
+            item = expiry.live(fetched[1])
+            if expiry.due(item):
+                await r.add_expired(*expiry.take())
+            if item is None:
+                slots.release()
+                continue
+            in_flight[asyncio.create_task(handle(item))] = fetched[0], item
+        if in_flight:
+            await asyncio.wait(list(in_flight))
+        stopped = 'worker {worker_id} retired\n' if retiring.is_set() else 'timeout reached worker {worker_id} stopped\n'
+        sys.stdout.write(stopped.format(worker_id=worker_id))
+    except asyncio.CancelledError:
+        sys.stdout.write('worker {worker_id} stopped\n'.format(worker_id=worker_id))
+        unprocessed = list(in_flight.values())
+        for task in in_flight:
+            task.cancel()
+        await asyncio.gather(*in_flight, return_exceptions=True)
+        await r.push_back(unprocessed)
+    finally:
+        if fetching is not None:
+            fetching.cancel()
+        if expiry.count:
+            await r.add_expired(*expiry.take())
+        if r.buffer:
+            await r.push_back()
+        await r.close()
+
+
+def run_threaded_worker(func, func_kwargs, on_failure_func, config, worker_id, init_kwargs):  # noqa:C901
+    """Runs func on threads_per_worker threads, fed by a single consumer loop.
+
+    The loop only fetches when a thread is free, so at most threads_per_worker
+    items, or batches, are in flight. On shutdown the items of every thread
+    are pushed back, the threads are daemons and are abandoned with the process.
+    """
+    started = time.monotonic()
+    if config.get('backend') == 'stream':
+        raise ValueError("threads_per_worker does not support the stream backend, entries are acknowledged in order")
+    if config.get('task_timeout'):
+        raise ValueError("threads_per_worker does not support task_timeout, only the main thread can be interrupted")
+    retry, config = retry_policy(config)
+    pass_envelope = config.get('envelope', False)
+    expiry = Expiry(config.get('expired_list', False))
+    loads, loads_batch = worker_loads(config)
+    max_batch, max_wait_ms = config.get('max_batch'), config.get('max_wait_ms')
+    batched = config.get('batch_size') is not None
+    reliable = config.get('reliable', False)
+    recycler = Recycler(config.get('max_tasks_per_worker'), config.get('max_rss_mb'),
+                        config.get('rss_report_interval', 10))
+    try:
+        func_kwargs = init_add(func_kwargs, setup_init_items(func_kwargs, init_kwargs), init_kwargs)
+    except InitFail:
+        sys.stdout.write('worker {worker_id} initialization failed\n'.format(worker_id=worker_id))
+        traceback.print_exc()
+        return
+    r = make_queue(config)
+    work, free, lock = SimpleQueue(), threading.Semaphore(config['threads_per_worker']), threading.Lock()
+    # Items handed to the threads and not handled yet, by a token of the consumer loop.
+    in_flight, tokens = {}, count()
+
+    def run(key_name, item):
+        try:
+            payload, envelope = open_item(item, r)
+            if max_batch is not None:
+                func(loads_batch(payload), worker_id, **handler_kwargs(func_kwargs, envelope, pass_envelope))
+            else:
+                func(loads(payload), worker_id, **handler_kwargs(func_kwargs, envelope, pass_envelope))
+        except Exception as e:
+            sys.stdout.write('worker {worker_id} failed reason {e}\n'.format(worker_id=worker_id, e=e))
+            if on_failure_func is not None:
+                sys.stdout.write('worker {worker_id} running failure handler {e}\n'.format(worker_id=worker_id, e=e))
+                try:
+                    on_failure_func(failed_payload(item, r), e, r, worker_id)
+                except Exception as handler_error:
+                    sys.stdout.write('worker {worker_id} failure handler failed reason {e}\n'.format(
+                        worker_id=worker_id, e=handler_error))
+            retry.failed(r, item, key_name)
+        else:
+            r.release(item)
+        if reliable:
+            r.ack(item)
+        with lock:
+            recycler.done(r, len(item) if max_batch is not None else 1)
+
+    def handle():
+        for token, key_name, item in iter(work.get, None):
+            try:
+                run(key_name, item)
+            except Exception as e:
+                # Retrying, acknowledging or reporting failed, the thread and its slot stay in service.
+                sys.stdout.write('worker {worker_id} failed reason {e}\n'.format(worker_id=worker_id, e=e))
+            finally:
+                with lock:
+                    in_flight.pop(token, None)
+                free.release()
+
+    def fetch():
+        if max_batch is not None:
+            return r.next_batch(max_batch, max_wait_ms)
+        return next(r, (None, None))
+
+    threads = [threading.Thread(target=handle, name='worker-{}-{}'.format(worker_id, n), daemon=True)
+               for n in range(config['threads_per_worker'])]
+    for thread in threads:
+        thread.start()
+    sys.stdout.write('worker {worker_id} started. {func_name} listening to {queue} with {threads} threads\n'.format(
+        worker_id=worker_id, func_name=func.__name__, queue=config["key"], threads=len(threads)))
+    sys.stdout.write('worker {worker_id} ready in {seconds:.3f}s, private memory {private:.1f} MB\n'.format(
+        worker_id=worker_id, seconds=time.monotonic() - started, private=private_mb()))
+    try:
+        while not recycler.recycle:
+            free.acquire()
+            try:
+                key_name, item = recycler.fetch((None, None), fetch)
+            except Exception as e:
+                free.release()
+                sys.stdout.write('worker {worker_id} failed reason {e}\n'.format(worker_id=worker_id, e=e))
+                time.sleep(0.1)  # Throttle restarting
+                continue
+            # The timeout was reached, an empty item is a valid item.
+            if key_name is None or item == []:
+                break
+            live = expiry.live(item)
+            if expiry.due(live):
+                expiry.flush(r)
+            dropped = expiry.dropped(item, live)
+            if reliable and dropped:
+                r.ack(dropped)
+            if live is None:
+                free.release()
+                continue
+            item = live
+            token = next(tokens)
+            with lock:
+                in_flight[token] = key_name, item
+            work.put((token, key_name, item))
+        for thread in threads:
+            work.put(None)
+        for thread in threads:
+            thread.join()
+    except (KeyboardInterrupt, SystemExit):
+        sys.stdout.write('worker {worker_id} stopped\n'.format(worker_id=worker_id))
+        expiry.flush(r)
+        with lock:
+            unprocessed = [(key_name, i) for key_name, item in in_flight.values()
+                           for i in (item if isinstance(item, list) else [item])]
+            in_flight.clear()
+        if reliable:
+            r.requeue_processing()
+            return
+        r.push_back(unprocessed)
+        return
+    if recycler.recycle:
+        sys.stdout.write('worker {worker_id} recycled after {tasks} tasks, rss {rss} MB\n'.format(
+            worker_id=worker_id, tasks=recycler.tasks, rss=round(recycler.rss or rss_mb(), 1)))
+    elif recycler.retired:
+        sys.stdout.write('worker {worker_id} retired\n'.format(worker_id=worker_id))
+    else:
+        sys.stdout.write('timeout reached worker {worker_id} stopped\n'.format(worker_id=worker_id))
+    expiry.flush(r)
+    if reliable:
+        r.requeue_processing()
+    elif (batched or max_batch is not None) and r.buffer:
+        r.push_back()
+    if recycler.max_rss_mb is not None:
+        r.report_rss(None)
+    return recycler.recycle or None
+
+
 def run_worker(func, func_kwargs, on_failure_func, config, worker_id, init_kwargs):  # noqa:C901
+    started = time.monotonic()
     if isinstance(func, list):
         func = func[worker_id % len(func)]
     if isinstance(config, list):
         config = config[worker_id % len(config)]
+    if asyncio.iscoroutinefunction(func):
+        return asyncio.run(run_async_worker(func, func_kwargs, on_failure_func, config, worker_id, init_kwargs))
+    if (config.get('threads_per_worker') or 1) > 1:
+        return run_threaded_worker(func, func_kwargs, on_failure_func, config, worker_id, init_kwargs)
 
-    item, r = None, None
+    key_name, item, r = None, None, None
+    max_batch, max_wait_ms = config.get('max_batch'), config.get('max_wait_ms')
+    batched = config.get('batch_size') is not None or max_batch is not None
+    # Stream entries are acknowledged like items of a reliable list queue.
+    reliable = config.get('reliable', False) or config.get('backend') == 'stream'
+    recycler = Recycler(config.get('max_tasks_per_worker'), config.get('max_rss_mb'),
+                        config.get('rss_report_interval', 10))
+    task_timeout = config.get('task_timeout')
+    if task_timeout:
+        signal.signal(signal.SIGALRM, raise_task_timeout)
+    retry, config = retry_policy(config)
+    pass_envelope = config.get('envelope', False)
+    expiry = Expiry(config.get('expired_list', False))
+    loads, loads_batch = worker_loads(config)
     init_items = setup_init_items(func_kwargs, init_kwargs)
     while True:
         try:
             func_kwargs = init_add(func_kwargs, init_items, init_kwargs)
-            r = RedisQueue(**config)  # TODO rename r
+            # The queue, and the items it has fetched, survive restarting after a failure.
+            # Connections are recovered by the shared connection pool.
+            if r is None:
+                r = make_queue(config)  # TODO rename r
+                sys.stdout.write('worker {worker_id} ready in {seconds:.3f}s, private memory {private:.1f} MB\n'.format(
+                    worker_id=worker_id, seconds=time.monotonic() - started, private=private_mb()))
             sys.stdout.write('worker {worker_id} started. {func_name} listening to {queue} \n'.format(
                 worker_id=worker_id, func_name=func.__name__, queue=config["key"]))
-            for key_name, item in r:
-                _, item = func(item.decode('utf-8'), worker_id, **func_kwargs), None
+            if max_batch is not None:
+                while True:
+                    key_name, item = recycler.fetch((None, []), r.next_batch, max_batch, max_wait_ms)
+                    if not item:
+                        break
+                    live = expiry.live(item)
+                    if expiry.due(live):
+                        expiry.flush(r)
+                    dropped = expiry.dropped(item, live)
+                    if reliable and dropped:
+                        r.ack(dropped)
+                    item = live
+                    if item is None:
+                        continue
+                    payload, envelope = open_item(item, r)
+                    with time_limit(task_timeout):
+                        func(loads_batch(payload), worker_id, **handler_kwargs(func_kwargs, envelope, pass_envelope))
+                    if reliable:
+                        r.ack(item)
+                    done, item = item, None
+                    r.release(done)
+                    if recycler.done(r, len(done)):
+                        break
+            else:
+                for key_name, item in recycler.fetching(r):
+                    live = expiry.live(item)
+                    if expiry.due(live):
+                        expiry.flush(r)
+                    if live is None:
+                        if reliable:
+                            r.ack(item)
+                        item = None
+                        continue
+                    payload, envelope = open_item(item, r)
+                    with time_limit(task_timeout):
+                        func(loads(payload), worker_id, **handler_kwargs(func_kwargs, envelope, pass_envelope))
+                    if reliable:
+                        r.ack(item)
+                    done, item = item, None
+                    r.release(done)
+                    if recycler.done(r):
+                        break
         except InitFail:
             sys.stdout.write('worker {worker_id} initialization failed\n'.format(worker_id=worker_id))
             traceback.print_exc()
             break
         except (KeyboardInterrupt, SystemExit):
             sys.stdout.write('worker {worker_id} stopped\n'.format(worker_id=worker_id))
-            if item is not None:
-                r.first_inline_send(item)
+            if r is not None:
+                expiry.flush(r)
+            if reliable and r is not None:
+                r.requeue_processing()
+                break
+            unprocessed = item if isinstance(item, list) else [item] if item is not None else []
+            if unprocessed or batched and r is not None and r.buffer:
+                r.push_back([(key_name, i) for i in unprocessed])
             break
         except Exception as e:
             sys.stdout.write('worker {worker_id} failed reason {e}\n'.format(worker_id=worker_id, e=e))
             if on_failure_func is not None:
                 sys.stdout.write('worker {worker_id} running failure handler {e}\n'.format(worker_id=worker_id, e=e))
-                on_failure_func(item, e, r, worker_id)
+                on_failure_func(None if item is None else failed_payload(item, r), e, r, worker_id)
+            if item is None:
+                time.sleep(0.1)  # Throttle reconnecting, a failed task moves on to the next item right away
+            else:
+                retry.failed(r, item, key_name)
+                if reliable:
+                    r.ack(item)
+                recycler.done(r, len(item) if isinstance(item, list) else 1)
             item = None
-            time.sleep(0.1)  # Throttle restarting
 
-        if config.get('timeout') is not None:
-            sys.stdout.write('timeout reached worker {worker_id} stopped\n'.format(worker_id=worker_id))
+        if recycler.recycle:
+            sys.stdout.write('worker {worker_id} recycled after {tasks} tasks, rss {rss} MB\n'.format(
+                worker_id=worker_id, tasks=recycler.tasks, rss=round(recycler.rss or rss_mb(), 1)))
+            if reliable:
+                r.requeue_processing()
+            elif batched and r.buffer:
+                r.push_back()
+            if recycler.max_rss_mb is not None:
+                r.report_rss(None)
+            expiry.flush(r)
+            return True
+
+        if recycler.retired or config.get('timeout') is not None:
+            stopped = 'worker {worker_id} retired\n' if recycler.retired else 'timeout reached worker {worker_id} stopped\n'
+            sys.stdout.write(stopped.format(worker_id=worker_id))
+            if r is not None:
+                expiry.flush(r)
+            if reliable and r is not None:
+                r.requeue_processing()
+            elif batched and r is not None and r.buffer:
+                r.push_back()
             break
 
 
-def startapp(func, func_kwargs={}, workers=10, config=config, on_failure_func=None, init_kwargs={}):
+# Exit code of a worker that stopped to be replaced, see Recycler.
+RECYCLE_EXIT_CODE = 75
+
+
+def supervised_worker(*args):
+    """Runs run_worker in a Supervisor process, exiting with RECYCLE_EXIT_CODE to be replaced."""
+    Recycler.supervised = True
+    if run_worker(*args):
+        sys.exit(RECYCLE_EXIT_CODE)
+
+
+class WorkerSlot:
+    """The worker processes of one function and queue config."""
+
+    def __init__(self, func, config, count):
+        self.func = func
+        self.config = config
+        self.minimum = self.maximum = count
+        self.processes = {}
+        # Crashed workers waiting to be restarted, worker_id to restart time.
+        self.restarts = {}
+        self.queue = None
+        self.backlog = None
+        self.idle = 0
+
+    @property
+    def autoscaled(self):
+        return self.minimum != self.maximum
+
+
+class Supervisor:
+    """Starts and owns the worker processes of startapp.
+
+    With autoscale, a mapping of queue key to (minimum, maximum) or a single
+    (minimum, maximum) for every queue, the amount of workers per queue moves
+    between those bounds. Every interval seconds the backlog of the queues is
+    sampled, with one pipeline per Redis instance. Workers are added when the
+    backlog is above backlog_per_worker per worker or has grown since the last
+    sample, and retired one at a time once the queue stayed empty for
+    idle_intervals samples.
+
+    A worker that dies, by a segfault, an OOM kill or an uncaught exception, is
+    restarted on its own with the same worker_id, without touching the other
+    workers. Restarts back off exponentially from backoff up to max_backoff
+    seconds, the backoff resets once a worker ran for max_backoff seconds.
+    """
+
+    def __init__(self, func, func_kwargs={}, workers=10, config=config, on_failure_func=None, init_kwargs={},
+                 autoscale=None, interval=1, backlog_per_worker=100, idle_intervals=5, backoff=0.5, max_backoff=30,
+                 start_method=None):
+        self.func_kwargs = func_kwargs
+        self.on_failure_func = on_failure_func
+        self.init_kwargs = init_kwargs
+        self.interval = interval
+        self.backlog_per_worker = backlog_per_worker
+        self.idle_intervals = idle_intervals
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.context = None if start_method is None else get_context(start_method)
+        self.crashes = {}
+        self.started = {}
+        self.slots = self.create_slots(func, workers, config)
+        self.set_autoscale(autoscale)
+        self.retiring = {}
+        self.free_ids = []
+        self.next_id = 1
+        self.finished = False
+
+    def create_slots(self, func, workers, config):
+        """Groups the workers the way run_worker maps worker_id to function and config."""
+        funcs = func if isinstance(func, list) else [func]
+        configs = config if isinstance(config, list) else [config]
+        slots = {}
+        for worker_id in range(1, max(workers, len(funcs), len(configs)) + 1):
+            slot_func, slot_config = funcs[worker_id % len(funcs)], configs[worker_id % len(configs)]
+            slot = slots.setdefault((id(slot_func), id(slot_config)), WorkerSlot(slot_func, slot_config, 0))
+            slot.minimum = slot.maximum = slot.minimum + 1
+        return list(slots.values())
+
+    def set_autoscale(self, autoscale):
+        if autoscale is None:
+            return
+        for slot in self.slots:
+            key = slot.config.get('key')
+            key = tuple(key) if isinstance(key, list) else key
+            bounds = autoscale.get(key) if isinstance(autoscale, dict) else autoscale
+            if bounds is not None:
+                slot.minimum, slot.maximum = bounds
+
+    def take_id(self):
+        if self.free_ids:
+            worker_id = min(self.free_ids)
+            self.free_ids.remove(worker_id)
+            return worker_id
+        self.next_id += 1
+        return self.next_id - 1
+
+    def spawn(self, slot, worker_id=None):
+        worker_id = self.take_id() if worker_id is None else worker_id
+        process_class = Process if self.context is None else self.context.Process
+        process = process_class(target=supervised_worker, args=(
+            slot.func, self.func_kwargs, self.on_failure_func, slot.config, worker_id, self.init_kwargs))
+        process.start()
+        slot.processes[worker_id] = process
+        self.started[worker_id] = time.monotonic()
+        return process
+
+    def restart_later(self, slot, worker_id, exitcode):
+        if time.monotonic() - self.started[worker_id] >= self.max_backoff:
+            self.crashes[worker_id] = 0
+        crashes = self.crashes.get(worker_id, 0)
+        self.crashes[worker_id] = crashes + 1
+        delay = min(self.backoff * 2 ** crashes, self.max_backoff)
+        slot.restarts[worker_id] = time.monotonic() + delay
+        sys.stdout.write('worker {worker_id} died with exit code {exitcode}, restarting in {delay}s\n'.format(
+            worker_id=worker_id, exitcode=exitcode, delay=delay))
+
+    def restart_due(self):
+        """Restarts the crashed workers whose backoff has passed, returns the seconds until the next one."""
+        now = time.monotonic()
+        next_restart = float('inf')
+        for slot in self.slots:
+            for worker_id, due in list(slot.restarts.items()):
+                if due <= now:
+                    del slot.restarts[worker_id]
+                    self.spawn(slot, worker_id)
+                else:
+                    next_restart = min(next_restart, due - now)
+        return next_restart
+
+    def retire(self, slot):
+        """Stops one worker of slot with SIGTERM, it stops after the item it is handling, see Recycler.
+
+        A crashed worker waiting to be restarted is retired first, by cancelling its restart.
+        """
+        if slot.restarts:
+            worker_id = max(slot.restarts)
+            del slot.restarts[worker_id]
+            self.crashes.pop(worker_id, None)
+            self.free_ids.append(worker_id)
+            sys.stdout.write('supervisor cancelled restart of worker {worker_id}\n'.format(worker_id=worker_id))
+            return
+        worker_id = max(slot.processes)
+        process = slot.processes.pop(worker_id)
+        self.retiring[worker_id] = process
+        os.kill(process.pid, signal.SIGTERM)
+        sys.stdout.write('supervisor retiring worker {worker_id}\n'.format(worker_id=worker_id))
+
+    def sample(self, slots):
+        """Returns the backlog of every slot, with one pipeline per connection pool."""
+        pipes = {}
+        for slot in slots:
+            if slot.queue is None:
+                slot.queue = make_queue(slot.config)
+            pool = slot.queue.r.connection_pool
+            if pool not in pipes:
+                pipes[pool] = (slot.queue.r.pipeline(transaction=False), [])
+            pipe, counted = pipes[pool]
+            counted.append((slot, slot.queue.add_len(pipe)))
+        backlogs = {}
+        for pipe, counted in pipes.values():
+            results = iter(pipe.execute())
+            for slot, commands in counted:
+                backlogs[id(slot)] = slot.queue.parse_len([next(results) for _ in range(commands)])
+        return [backlogs[id(slot)] for slot in slots]
+
+    def scale(self):
+        slots = [slot for slot in self.slots if slot.autoscaled]
+        if not slots:
+            return
+        for slot, backlog in zip(slots, self.sample(slots)):
+            current = len(slot.processes) + len(slot.restarts)
+            target = math.ceil(backlog / self.backlog_per_worker)
+            # A growing backlog means the workers are falling behind.
+            if slot.backlog is not None and backlog > slot.backlog:
+                target = max(target, current + 1)
+            target = min(max(target, slot.minimum), slot.maximum)
+            slot.backlog = backlog
+            slot.idle = slot.idle + 1 if backlog == 0 else 0
+            for _ in range(target - current):
+                self.spawn(slot)
+            if target < current and slot.idle >= self.idle_intervals:
+                self.retire(slot)
+                slot.idle = 0
+
+    def exited(self, process):
+        """Forgets a worker process that has exited."""
+        process.join()
+        for worker_id, retired in list(self.retiring.items()):
+            if retired is process:
+                del self.retiring[worker_id]
+                self.free_ids.append(worker_id)
+                return
+        for slot in self.slots:
+            for worker_id, owned in list(slot.processes.items()):
+                if owned is process:
+                    del slot.processes[worker_id]
+                    if process.exitcode == RECYCLE_EXIT_CODE:
+                        self.spawn(slot, worker_id)
+                        return
+                    if process.exitcode != 0:
+                        self.restart_later(slot, worker_id, process.exitcode)
+                        return
+                    # Stopped by itself, the timeout was reached.
+                    self.free_ids.append(worker_id)
+                    self.finished = True
+                    return
+
+    def processes(self):
+        owned = [process for slot in self.slots for process in slot.processes.values()]
+        return owned + list(self.retiring.values())
+
+    def run(self):
+        started = time.monotonic()
+        for slot in self.slots:
+            for _ in range(slot.minimum):
+                self.spawn(slot)
+        sys.stdout.write('supervisor started {workers} workers in {seconds:.3f}s\n'.format(
+            workers=len(self.processes()), seconds=time.monotonic() - started))
+        next_sample = time.monotonic() + self.interval
+        try:
+            while not (self.finished and not self.processes() and not any(slot.restarts for slot in self.slots)):
+                next_restart = self.restart_due()
+                timeout = max(min(next_sample - time.monotonic(), next_restart), 0)
+                for sentinel in wait([process.sentinel for process in self.processes()], timeout):
+                    self.exited(next(process for process in self.processes() if process.sentinel == sentinel))
+                # Once workers stop by themselves on their timeout, the app is winding down.
+                if time.monotonic() >= next_sample and not self.finished:
+                    self.scale()
+                    next_sample = time.monotonic() + self.interval
+        except (KeyboardInterrupt, SystemExit):
+            sys.stdout.write('Starting Graceful exit\n')
+            self.stop()
+
+    def stop(self, grace=1):
+        """Waits for the workers to stop, interrupting the ones still running after grace seconds."""
+        processes = self.processes()
+        for process in processes:
+            process.join(grace)
+        for process in processes:
+            if process.is_alive():
+                os.kill(process.pid, signal.SIGINT)
+        for process in processes:
+            process.join()
+
+
+def startapp(func, func_kwargs={}, workers=10, config=config, on_failure_func=None, init_kwargs={}, autoscale=None,
+             supervise=False, preload=None, shared_kwargs={}, threads_per_worker=None):
+    """Starts workers processes running func.
+
+    With supervise or autoscale, the processes are owned by a Supervisor that
+    restarts crashed workers one by one, else a multiprocessing Pool runs them.
+    Recycling workers, with max_tasks_per_worker or max_rss_mb, need the
+    Supervisor to be replaced.
+
+    preload, a list of module names, and shared_kwargs are set up once before
+    the workers are forked by the Supervisor, see preload_app. A Pool would
+    pickle them for every worker.
+
+    threads_per_worker runs func on that many threads in every worker
+    process, see run_threaded_worker.
+    """
+    if threads_per_worker is not None:
+        if isinstance(config, list):
+            config = [{**c, 'threads_per_worker': threads_per_worker} for c in config]
+        else:
+            config = {**config, 'threads_per_worker': threads_per_worker}
+    configs = config if isinstance(config, list) else [config]
+    recycles = any(c.get('max_tasks_per_worker') or c.get('max_rss_mb') for c in configs)
+    preloaded = preload is not None or bool(shared_kwargs)
+    if preloaded:
+        func_kwargs = preload_app(preload or (), func_kwargs, shared_kwargs)
+    if supervise or recycles or preloaded or autoscale is not None:
+        start_method = 'fork' if preloaded else None
+        Supervisor(func, func_kwargs, workers, config, on_failure_func, init_kwargs, autoscale=autoscale,
+                   start_method=start_method).run()
+        sys.stdout.write('Clean shut down\n')
+        return
     with Pool(workers) as p:
         args = ((func, func_kwargs, on_failure_func, config, worker_id, init_kwargs)
                 for worker_id in range(1, workers + 1))
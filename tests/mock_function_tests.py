@@ -1,13 +1,28 @@
+import os
 import json
+import array
+import pickle
+import time
+import asyncio
 
+import tempfile
 import unittest
 
+import meesee
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 from unittest import mock
-from unittest.mock import patch, MagicMock, call
+from unittest.mock import patch, MagicMock, AsyncMock, call
 
 from meesee import Meesee, config
 from meesee import init_add, setup_init_items, InitFail
-from meesee import startapp, run_worker, RedisQueue
+from meesee import startapp, run_worker, RedisQueue, StreamQueue, AsyncRedisQueue, make_queue, make_async_queue
+from meesee import get_connection_pool, connection_pools
+from meesee import Supervisor
 
 
 class TestWorkerProducerLineCoverage(unittest.TestCase):
@@ -124,6 +139,44 @@ class TestStartWorkers(unittest.TestCase):
             config=custom_config
         )
 
+    @patch('meesee.startapp')
+    def test_start_workers_per_queue(self, mock_startapp):
+        resize, email = MagicMock(), MagicMock()
+        self.box._worker_funcs = {'resize': resize, 'email': email}
+        self.box.start_workers(workers={'resize': 3})
+        mock_startapp.assert_called_once_with([resize, resize, resize, email], workers=4, config=config)
+
+
+class TestPushButtonWorkers(unittest.TestCase):
+    def setUp(self):
+        self.box = Meesee(namespace="test")
+
+    @patch('meesee.startapp')
+    def test_push_button_per_queue(self, mock_startapp):
+        resize, email = MagicMock(), MagicMock()
+        self.box._worker_funcs = {'resize': resize, 'email': email}
+        self.box.push_button(workers={'resize': 3, 'email': 2})
+
+        args, kwargs = mock_startapp.call_args
+        self.assertEqual(args[0], [resize, resize, resize, email, email])
+        self.assertEqual(kwargs['workers'], 5)
+        self.assertEqual([c['key'] for c in kwargs['config']], ['resize', 'resize', 'resize', 'email', 'email'])
+        # Every worker_id maps to its own entry.
+        indexes = sorted(worker_id % kwargs['workers'] for worker_id in range(1, kwargs['workers'] + 1))
+        self.assertEqual(indexes, list(range(5)))
+
+    @patch('meesee.startapp')
+    def test_push_button_total(self, mock_startapp):
+        self.box._worker_funcs = {'resize': MagicMock(), 'email': MagicMock()}
+        self.box.push_button(workers=4)
+        self.assertEqual(mock_startapp.call_args[1]['workers'], 4)
+        self.assertEqual([c['key'] for c in mock_startapp.call_args[1]['config']], ['resize', 'email'])
+
+    def test_push_button_unknown_queue(self):
+        self.box._worker_funcs = {'resize': MagicMock()}
+        with self.assertRaises(ValueError):
+            self.box.push_button(workers={'email': 2})
+
 
 class TestMeeseUtilityFunctions(unittest.TestCase):
 
@@ -198,6 +251,182 @@ class TestStartAppExitScenarios(unittest.TestCase):
         mock_pool_instance.close.assert_not_called()
         mock_pool_instance.join.assert_not_called()
 
+    @patch('meesee.Supervisor')
+    @patch('sys.stdout.write')
+    def test_autoscale(self, mock_stdout_write, mock_supervisor):
+        startapp(MagicMock(), workers=2, autoscale={'tasks': (1, 4)})
+
+        mock_supervisor.assert_called_once_with(mock.ANY, {}, 2, config, None, {}, autoscale={'tasks': (1, 4)},
+                                                start_method=None)
+        mock_supervisor.return_value.run.assert_called_once_with()
+        mock_stdout_write.assert_called_once_with('Clean shut down\n')
+
+    @patch('meesee.gc.freeze')
+    @patch('meesee.Supervisor')
+    @patch('sys.stdout.write')
+    def test_preload(self, mock_stdout_write, mock_supervisor, mock_freeze):
+        table = MagicMock(return_value={'big': 'table'})
+        func_kwargs = {'table': table, 'name': 'x'}
+        startapp(MagicMock(), func_kwargs=func_kwargs, workers=2, preload=['json'],
+                 shared_kwargs={'table': {'size': 10}})
+
+        table.assert_called_once_with(size=10)
+        mock_freeze.assert_called_once_with()
+        mock_supervisor.assert_called_once_with(mock.ANY, {'table': {'big': 'table'}, 'name': 'x'}, 2, config, None, {},
+                                                autoscale=None, start_method='fork')
+        self.assertIs(func_kwargs['table'], table)
+        self.assertTrue(mock_stdout_write.call_args_list[0][0][0].startswith('preloaded in '))
+
+    @patch('meesee.Pool')
+    @patch('sys.stdout.write')
+    def test_threads_per_worker(self, mock_stdout_write, mock_pool):
+        startapp(MagicMock(), workers=2, config=[{'key': 'a'}, {'key': 'b'}], threads_per_worker=8)
+
+        args = list(mock_pool.return_value.__enter__.return_value.starmap.call_args[0][1])
+        self.assertEqual(args[0][3], [{'key': 'a', 'threads_per_worker': 8}, {'key': 'b', 'threads_per_worker': 8}])
+
+    @patch('meesee.Pool')
+    @patch('meesee.Supervisor')
+    @patch('sys.stdout.write')
+    def test_recycling_workers_are_supervised(self, mock_stdout_write, mock_supervisor, mock_pool):
+        startapp(MagicMock(), workers=2, config=[{'key': 'a'}, {'key': 'b', 'max_tasks_per_worker': 1000}])
+
+        mock_supervisor.return_value.run.assert_called_once_with()
+        mock_pool.assert_not_called()
+
+
+class TestSupervisor(unittest.TestCase):
+
+    def setUp(self):
+        self.func_a, self.func_b = MagicMock(), MagicMock()
+        self.config_a, self.config_b = {'key': 'a'}, {'key': 'b'}
+        self.supervisor = Supervisor([self.func_a, self.func_b], workers=5, config=[self.config_a, self.config_b],
+                                     autoscale={'a': (1, 4)}, backlog_per_worker=10, idle_intervals=2)
+        self.slot_a, self.slot_b = sorted(self.supervisor.slots, key=lambda slot: slot.config['key'])
+
+    def test_slots(self):
+        self.assertEqual((self.slot_a.minimum, self.slot_a.maximum), (1, 4))
+        self.assertEqual((self.slot_b.minimum, self.slot_b.maximum), (3, 3))
+        self.assertTrue(self.slot_a.autoscaled)
+        self.assertFalse(self.slot_b.autoscaled)
+
+    @patch('meesee.Process')
+    def test_spawn(self, mock_process):
+        self.supervisor.spawn(self.slot_a)
+        self.supervisor.spawn(self.slot_a)
+        mock_process.assert_called_with(target=mock.ANY, args=(self.func_a, {}, None, self.config_a, 2, {}))
+        self.assertEqual(sorted(self.slot_a.processes), [1, 2])
+
+    @patch('meesee.Process')
+    def test_scale_up_on_backlog(self, mock_process):
+        self.supervisor.sample = MagicMock(return_value=[25])
+        self.supervisor.scale()
+        self.assertEqual(len(self.slot_a.processes), 3)
+        self.supervisor.sample.assert_called_once_with([self.slot_a])
+
+    @patch('meesee.Process')
+    def test_scale_up_on_growth(self, mock_process):
+        self.supervisor.spawn(self.slot_a)
+        self.supervisor.sample = MagicMock(side_effect=[[2], [5]])
+        self.supervisor.scale()
+        self.assertEqual(len(self.slot_a.processes), 1)
+        self.supervisor.scale()
+        self.assertEqual(len(self.slot_a.processes), 2)
+
+    @patch('os.kill')
+    @patch('meesee.Process')
+    @patch('sys.stdout.write')
+    def test_retire_when_idle(self, mock_stdout_write, mock_process, mock_kill):
+        self.supervisor.spawn(self.slot_a)
+        self.supervisor.spawn(self.slot_a)
+        self.supervisor.sample = MagicMock(return_value=[0])
+        self.supervisor.scale()
+        mock_kill.assert_not_called()
+        self.supervisor.scale()
+        mock_kill.assert_called_once_with(mock_process.return_value.pid, meesee.signal.SIGTERM)
+        self.assertEqual(list(self.slot_a.processes), [1])
+        self.assertEqual(list(self.supervisor.retiring), [2])
+
+        self.supervisor.exited(mock_process.return_value)
+        self.assertEqual(self.supervisor.retiring, {})
+        self.assertEqual(self.supervisor.take_id(), 2)
+        self.assertFalse(self.supervisor.finished)
+
+    @patch('os.kill')
+    @patch('meesee.Process')
+    @patch('sys.stdout.write')
+    def test_retire_cancels_restart(self, mock_stdout_write, mock_process, mock_kill):
+        self.supervisor.spawn(self.slot_a)
+        self.slot_a.restarts[4] = float('inf')
+        self.supervisor.sample = MagicMock(return_value=[0])
+        for _ in range(self.supervisor.idle_intervals):
+            self.supervisor.scale()
+        mock_kill.assert_not_called()
+        self.assertEqual(self.slot_a.restarts, {})
+        self.assertEqual(list(self.slot_a.processes), [1])
+        self.assertEqual(self.supervisor.take_id(), 4)
+        mock_stdout_write.assert_called_once_with('supervisor cancelled restart of worker 4\n')
+
+    def test_exited_by_itself(self):
+        process = MagicMock(exitcode=0)
+        self.slot_b.processes[3] = process
+        self.supervisor.exited(process)
+        process.join.assert_called_once_with()
+        self.assertTrue(self.supervisor.finished)
+        self.assertEqual(self.slot_b.processes, {})
+
+    @patch('meesee.time.monotonic')
+    @patch('meesee.Process')
+    @patch('sys.stdout.write')
+    def test_crashed_worker_restarts_with_backoff(self, mock_stdout_write, mock_process, mock_monotonic):
+        crashed, sibling = MagicMock(exitcode=-9), MagicMock()
+        mock_process.side_effect = [crashed, sibling, MagicMock(), MagicMock()]
+        mock_monotonic.return_value = 100
+        self.supervisor.spawn(self.slot_b)
+        self.supervisor.spawn(self.slot_b)
+
+        self.supervisor.exited(crashed)
+        self.assertFalse(self.supervisor.finished)
+        self.assertEqual(self.slot_b.restarts, {1: 100.5})
+        self.assertEqual(list(self.slot_b.processes), [2])
+        mock_stdout_write.assert_called_with('worker 1 died with exit code -9, restarting in 0.5s\n')
+
+        self.assertEqual(self.supervisor.restart_due(), 0.5)
+        mock_monotonic.return_value = 100.5
+        self.assertEqual(self.supervisor.restart_due(), float('inf'))
+        self.assertEqual(sorted(self.slot_b.processes), [1, 2])
+        self.assertIs(self.slot_b.processes[2], sibling)
+        sibling.terminate.assert_not_called()
+
+        # Crashing again right away doubles the backoff.
+        restarted = self.slot_b.processes[1]
+        restarted.exitcode = 1
+        self.supervisor.exited(restarted)
+        self.assertEqual(self.slot_b.restarts, {1: 101.5})
+
+    @patch('meesee.Process')
+    def test_recycled_worker_is_replaced(self, mock_process):
+        recycled = MagicMock(exitcode=meesee.RECYCLE_EXIT_CODE)
+        mock_process.side_effect = [recycled, MagicMock()]
+        self.supervisor.spawn(self.slot_b)
+
+        self.supervisor.exited(recycled)
+        self.assertEqual(list(self.slot_b.processes), [1])
+        self.assertIsNot(self.slot_b.processes[1], recycled)
+        self.assertEqual(self.slot_b.restarts, {})
+        self.assertFalse(self.supervisor.finished)
+
+    @patch('meesee.redis.Redis')
+    def test_sample_one_pipeline_per_pool(self, mock_redis):
+        self.slot_b.config = {'namespace': 'ns', 'key': ['b1', 'b2'], 'redis_config': {}}
+        self.slot_a.config = {'namespace': 'ns', 'key': 'a', 'redis_config': {}}
+        pipe = mock_redis.return_value.pipeline.return_value
+        pipe.execute.return_value = [3, 1, 2]
+
+        self.assertEqual(self.supervisor.sample([self.slot_b, self.slot_a]), [4, 2])
+        pipe.llen.assert_has_calls([call('ns:b1'), call('ns:b2'), call('ns:a')])
+        pipe.execute.assert_called_once_with()
+
 
 class TestRunWorker(unittest.TestCase):
 
@@ -290,7 +519,522 @@ class TestRunWorker(unittest.TestCase):
 
         run_worker(mock_func, {}, None, config, 1, {})
         mock_stdout_write.assert_any_call('worker 1 stopped\n')
-        mock_redis_queue.return_value.first_inline_send.assert_called_once_with(b'test_item2')
+        mock_redis_queue.return_value.push_back.assert_called_once_with([('key2', b'test_item2')])
+
+    @patch.object(meesee.Recycler, 'supervised', True)
+    @patch('meesee.signal.signal')
+    @patch('meesee.RedisQueue')
+    @patch('sys.stdout.write')
+    def test_run_worker_retired_while_handling(self, mock_stdout_write, mock_redis_queue, mock_signal):
+        handled = []
+
+        def func(item, worker_id):
+            handled.append(item)
+            mock_signal.call_args[0][1](meesee.signal.SIGTERM, None)
+
+        queue = mock_redis_queue.return_value
+        queue.__iter__.return_value = iter([(b'q', b'a'), (b'q', b'b')])
+        run_worker(func, {}, None, {'key': 'test_queue'}, 1, {})
+
+        self.assertEqual(handled, ['a'])
+        mock_signal.assert_called_once_with(meesee.signal.SIGTERM, mock.ANY)
+        queue.release.assert_called_once_with(b'a')
+        queue.push_back.assert_not_called()
+        self.assertEqual(mock_stdout_write.call_args_list[-1], call('worker 1 retired\n'))
+
+    @patch.object(meesee.Recycler, 'supervised', True)
+    @patch('meesee.signal.signal')
+    @patch('meesee.RedisQueue')
+    @patch('sys.stdout.write')
+    def test_run_worker_retired_while_waiting(self, mock_stdout_write, mock_redis_queue, mock_signal):
+        handled = []
+
+        def fetched():
+            yield b'q', b'a'
+            # SIGTERM arrives while blocked on the queue.
+            mock_signal.call_args[0][1](meesee.signal.SIGTERM, None)
+
+        mock_redis_queue.return_value.__iter__.return_value = fetched()
+        run_worker(lambda item, worker_id: handled.append(item), {}, None, {'key': 'test_queue'}, 1, {})
+
+        self.assertEqual(handled, ['a'])
+        self.assertEqual(mock_stdout_write.call_args_list[-1], call('worker 1 retired\n'))
+
+    @patch('meesee.setup_init_items', return_value={})
+    @patch('meesee.init_add', return_value={})
+    @patch('meesee.redis.Redis')
+    @patch('sys.stdout.write')
+    def test_run_worker_batch_interrupt_pushes_back_batch(self, mock_stdout_write, mock_redis, mock_init_add, mock_setup_init_items):
+        pipe = mock_redis.return_value.pipeline.return_value.__enter__.return_value
+        pipe.execute.return_value = [(b'test:q', b'item1'), [b'item2', b'item3']]
+
+        def func(item, worker_id):
+            if item == 'item2':
+                raise KeyboardInterrupt()
+
+        config = {'namespace': 'test', 'key': 'q', 'redis_config': {}, 'batch_size': 3}
+        run_worker(func, {}, None, config, 1, {})
+
+        mock_stdout_write.assert_any_call('worker 1 stopped\n')
+        pipe.lpush.assert_called_once_with('test:q', b'item3', b'item2')
+
+    @patch('meesee.setup_init_items', return_value={})
+    @patch('meesee.init_add', return_value={})
+    @patch('meesee.RedisQueue')
+    @patch('sys.stdout.write')
+    @patch('time.sleep')
+    def test_run_worker_batch_worker(self, mock_sleep, mock_stdout_write, mock_redis_queue, mock_init_add, mock_setup_init_items):
+        batches = iter([(b'q', [b'a', b'b']), (b'q', [b'fail']), (b'q', [])])
+        mock_redis_queue.return_value.next_batch.side_effect = lambda *args: next(batches)
+        received = []
+
+        def func(items, worker_id):
+            if items == ['fail']:
+                raise Exception("Test exception")
+            received.append(items)
+
+        mock_on_failure_func = MagicMock()
+        config = {'key': 'test_queue', 'timeout': 1, 'max_batch': 2, 'max_wait_ms': 10}
+        run_worker(func, {}, mock_on_failure_func, config, 1, {})
+
+        self.assertEqual(received, [['a', 'b']])
+        mock_redis_queue.assert_called_with(key='test_queue', timeout=1)
+        mock_redis_queue.return_value.next_batch.assert_called_with(2, 10)
+        mock_on_failure_func.assert_called_once_with([b'fail'], mock.ANY, mock.ANY, 1)
+
+    @patch('meesee.setup_init_items', return_value={})
+    @patch('meesee.init_add', return_value={})
+    @patch('meesee.RedisQueue')
+    @patch('sys.stdout.write')
+    @patch('time.sleep')
+    def test_run_worker_batch_worker_reliable_failure(self, mock_sleep, mock_stdout_write, mock_redis_queue, mock_init_add,
+                                                      mock_setup_init_items):
+        queue = mock_redis_queue.return_value
+        batches = iter([(b'q', [b'fail', b'b']), (b'q', [b'c'])])
+
+        def next_batch(*args):
+            for batch in batches:
+                return batch
+            raise KeyboardInterrupt()
+
+        queue.next_batch.side_effect = next_batch
+        received = []
+
+        def func(items, worker_id):
+            if 'fail' in items:
+                raise Exception("Test exception")
+            received.append(items)
+
+        run_worker(func, {}, None, {'key': 'test_queue', 'reliable': True, 'max_batch': 2}, 1, {})
+
+        self.assertEqual(received, [['c']])
+        queue.ack.assert_has_calls([call([b'fail', b'b']), call([b'c'])])
+        queue.requeue_processing.assert_called_once_with()
+
+    @patch('meesee.setup_init_items', return_value={})
+    @patch('meesee.init_add', return_value={})
+    @patch('meesee.RedisQueue')
+    @patch('sys.stdout.write')
+    def test_run_worker_batch_worker_interrupt(self, mock_stdout_write, mock_redis_queue, mock_init_add, mock_setup_init_items):
+        mock_redis_queue.return_value.next_batch.return_value = (b'q', [b'a', b'b'])
+
+        def func(items, worker_id):
+            raise SystemExit()
+
+        config = {'key': 'test_queue', 'max_batch': 2}
+        run_worker(func, {}, None, config, 1, {})
+
+        mock_redis_queue.return_value.push_back.assert_called_once_with([(b'q', b'a'), (b'q', b'b')])
+
+    @patch('meesee.setup_init_items', return_value={})
+    @patch('meesee.init_add', return_value={})
+    @patch('meesee.RedisQueue')
+    @patch('sys.stdout.write')
+    def test_run_worker_batch_worker_interrupt_filling(self, mock_stdout_write, mock_redis_queue, mock_init_add,
+                                                       mock_setup_init_items):
+        queue = mock_redis_queue.return_value
+        queue.next_batch.side_effect = KeyboardInterrupt()
+        queue.buffer = [(b'q', b'a')]
+
+        run_worker(MagicMock(__name__='test_func'), {}, None, {'key': 'test_queue', 'max_batch': 5}, 1, {})
+
+        queue.push_back.assert_called_once_with([])
+
+    @patch('meesee.setup_init_items', return_value={})
+    @patch('meesee.init_add', return_value={})
+    @patch('meesee.RedisQueue')
+    @patch('sys.stdout.write')
+    def test_run_worker_reliable(self, mock_stdout_write, mock_redis_queue, mock_init_add, mock_setup_init_items):
+        mock_redis_queue.return_value.__iter__.return_value = iter([('key1', b'item1'), ('key2', b'item2')])
+
+        def func(item, worker_id):
+            if item == 'item2':
+                raise KeyboardInterrupt()
+
+        config = {'key': 'test_queue', 'reliable': True}
+        run_worker(func, {}, None, config, 1, {})
+
+        mock_redis_queue.return_value.ack.assert_called_once_with(b'item1')
+        mock_redis_queue.return_value.requeue_processing.assert_called_once_with()
+        mock_redis_queue.return_value.first_inline_send.assert_not_called()
+
+    @patch('meesee.setup_init_items', return_value={})
+    @patch('meesee.init_add', return_value={})
+    @patch('meesee.RedisQueue')
+    @patch('sys.stdout.write')
+    @patch('time.sleep')
+    def test_run_worker_task_timeout(self, mock_sleep, mock_stdout_write, mock_redis_queue, mock_init_add, mock_setup_init_items):
+        mock_redis_queue.return_value.__iter__.return_value = iter([(b'q', b'stuck'), (b'q', b'fast'), (b'q', b'stop')])
+        handled = []
+        mock_on_failure_func = MagicMock()
+
+        def func(item, worker_id):
+            if item == 'stuck':
+                meesee.threading.Event().wait(5)
+            if item == 'stop':
+                raise SystemExit()
+            handled.append(item)
+
+        config = {'key': 'test_queue', 'task_timeout': 0.05, 'reliable': True}
+        run_worker(func, {}, mock_on_failure_func, config, 1, {})
+
+        self.assertEqual(handled, ['fast'])
+        mock_on_failure_func.assert_called_once_with(b'stuck', mock.ANY, mock.ANY, 1)
+        self.assertIsInstance(mock_on_failure_func.call_args[0][1], meesee.TaskTimeout)
+        mock_redis_queue.return_value.ack.assert_has_calls([call(b'stuck'), call(b'fast')])
+        self.assertEqual(meesee.signal.getitimer(meesee.signal.ITIMER_REAL), (0.0, 0.0))
+
+    @patch('meesee.random.uniform', return_value=0.5)
+    @patch('meesee.setup_init_items', return_value={})
+    @patch('meesee.init_add', return_value={})
+    @patch('meesee.RedisQueue')
+    @patch('sys.stdout.write')
+    @patch('time.sleep')
+    def test_run_worker_retry(self, mock_sleep, mock_stdout_write, mock_redis_queue, mock_init_add, mock_setup_init_items,
+                              mock_uniform):
+        queue = mock_redis_queue.return_value
+        retried = meesee.Envelope(b'i' * 16, 2, 1.0, 0, 0)
+        queue.__iter__.return_value = iter([(b'q', b'fail'), (b'q', retried.pack('fail')), (b'q', b'stop')])
+        received = []
+        mock_on_failure_func = MagicMock()
+
+        def func(item, worker_id):
+            received.append(item)
+            if item == 'stop':
+                raise SystemExit()
+            raise Exception("Test exception")
+
+        config = {'key': 'test_queue', 'max_retries': 2, 'retry_backoff': 2, 'dead_letter': True}
+        run_worker(func, {}, mock_on_failure_func, config, 1, {})
+
+        self.assertEqual(received, ['fail', 'fail', 'stop'])
+        mock_on_failure_func.assert_has_calls([call(b'fail', mock.ANY, queue, 1)] * 2)
+        queue.send_in.assert_called_once_with(mock.ANY, 0.5, wrapped=True, key=b'q')
+        envelope, payload = meesee.Envelope.unpack(queue.send_in.call_args[0][0])
+        self.assertEqual((envelope.attempts, payload), (1, b'fail'))
+        mock_uniform.assert_called_once_with(0, 2)
+        queue.send_dead.assert_called_once_with(b'fail', key=b'q')
+        mock_redis_queue.assert_called_once_with(key='test_queue', promote_interval=1)
+        mock_sleep.assert_not_called()
+
+    @patch('meesee.setup_init_items', return_value={})
+    @patch('meesee.init_add', return_value={})
+    @patch('meesee.RedisQueue')
+    @patch('sys.stdout.write')
+    def test_run_worker_envelope(self, mock_stdout_write, mock_redis_queue, mock_init_add, mock_setup_init_items):
+        envelope = meesee.Envelope(b'i' * 16, 0, 1.0, 0, 0)
+        mock_redis_queue.return_value.__iter__.return_value = iter([(b'q', envelope.pack('a')), (b'q', b'b')])
+        mock_func = MagicMock(__name__='test_func', side_effect=[None, SystemExit()])
+
+        run_worker(mock_func, {}, None, {'key': 'test_queue', 'envelope': True}, 1, {})
+
+        self.assertEqual(mock_func.call_args_list, [call('a', 1, envelope=envelope), call('b', 1, envelope=None)])
+        mock_redis_queue.assert_called_once_with(key='test_queue', envelope=True)
+
+    @patch('meesee.setup_init_items', return_value={})
+    @patch('meesee.init_add', return_value={})
+    @patch('meesee.RedisQueue')
+    @patch('sys.stdout.write')
+    def test_run_worker_drops_expired(self, mock_stdout_write, mock_redis_queue, mock_init_add, mock_setup_init_items):
+        expired = meesee.Envelope.new(deadline=time.time() - 1).pack('old')
+        fresh = meesee.Envelope.new(deadline=time.time() + 60).pack('new')
+        queue = mock_redis_queue.return_value
+        queue.__iter__.return_value = iter([(b'q', expired), (b'q', fresh), (b'q', b'plain')])
+        mock_func = MagicMock(__name__='test_func', side_effect=[None, SystemExit()])
+
+        run_worker(mock_func, {}, None, {'key': 'test_queue', 'reliable': True, 'expired_list': True}, 1, {})
+
+        self.assertEqual(mock_func.call_args_list, [call('new', 1), call('plain', 1)])
+        queue.ack.assert_any_call(expired)
+        queue.add_expired.assert_called_once_with([b'old'], 1)
+        mock_redis_queue.assert_called_once_with(key='test_queue', reliable=True)
+
+    @patch('meesee.setup_init_items', return_value={})
+    @patch('meesee.init_add', return_value={})
+    @patch('meesee.RedisQueue')
+    @patch('sys.stdout.write')
+    def test_run_worker_reliable_batch_drops_expired(self, mock_stdout_write, mock_redis_queue, mock_init_add,
+                                                     mock_setup_init_items):
+        expired = meesee.Envelope.new(deadline=time.time() - 1).pack('old')
+        queue = mock_redis_queue.return_value
+        queue.next_batch.side_effect = [(b'q', [b'a', expired, b'b']), (b'q', [expired]), SystemExit()]
+        mock_func = MagicMock(__name__='test_func')
+
+        run_worker(mock_func, {}, None, {'key': 'test_queue', 'reliable': True, 'max_batch': 3}, 1, {})
+
+        mock_func.assert_called_once_with(['a', 'b'], 1)
+        self.assertEqual(queue.ack.call_args_list, [call([expired]), call([b'a', b'b']), call([expired])])
+        queue.requeue_processing.assert_called_once_with()
+
+    @patch('meesee.setup_init_items', return_value={})
+    @patch('meesee.init_add', return_value={})
+    @patch('meesee.RedisQueue')
+    @patch('sys.stdout.write')
+    def test_run_worker_serializer(self, mock_stdout_write, mock_redis_queue, mock_init_add, mock_setup_init_items):
+        mock_redis_queue.return_value.next_batch.side_effect = [(b'q', [b'{"a": 1}', b'[2]']), SystemExit()]
+        mock_func = MagicMock(__name__='test_func')
+
+        run_worker(mock_func, {}, None, {'key': 'test_queue', 'serializer': 'json', 'max_batch': 2}, 1, {})
+
+        mock_func.assert_called_once_with([{"a": 1}, [2]], 1)
+
+    @patch('meesee.setup_init_items', return_value={})
+    @patch('meesee.init_add', return_value={})
+    @patch('meesee.RedisQueue')
+    @patch('sys.stdout.write')
+    def test_run_worker_raw(self, mock_stdout_write, mock_redis_queue, mock_init_add, mock_setup_init_items):
+        payload = b'\x89PNG\xff'
+        mock_redis_queue.return_value.__iter__.return_value = iter([(b'q', payload)])
+        mock_func = MagicMock(__name__='test_func', side_effect=SystemExit())
+
+        run_worker(mock_func, {}, None, {'key': 'test_queue', 'raw': True}, 1, {})
+
+        self.assertIs(mock_func.call_args[0][0], payload)
+        mock_redis_queue.assert_called_once_with(key='test_queue')
+
+    @patch('meesee.setup_init_items', return_value={})
+    @patch('meesee.init_add', return_value={})
+    @patch('meesee.RedisQueue')
+    @patch('sys.stdout.write')
+    def test_run_worker_claims_offloaded(self, mock_stdout_write, mock_redis_queue, mock_init_add,
+                                         mock_setup_init_items):
+        envelope = meesee.Envelope.new(flags=meesee.OFFLOAD_REDIS)
+        item = envelope.pack(b'')
+        queue = mock_redis_queue.return_value
+        queue.__iter__.return_value = iter([(b'q', item), (b'q', item)])
+        queue.claim.return_value = b'large payload'
+        mock_func = MagicMock(__name__='test_func', side_effect=[None, SystemExit()])
+
+        run_worker(mock_func, {}, None, {'key': 'test_queue', 'offload': 'redis'}, 1, {})
+
+        self.assertEqual(mock_func.call_args_list, [call('large payload', 1)] * 2)
+        queue.claim.assert_called_with(envelope, b'')
+        queue.release.assert_called_once_with(item)
+
+    @unittest.skipIf(numpy is None, "numpy is not installed")
+    @patch('meesee.setup_init_items', return_value={})
+    @patch('meesee.init_add', return_value={})
+    @patch('meesee.RedisQueue')
+    @patch('sys.stdout.write')
+    def test_run_worker_stacks_ndarrays(self, mock_stdout_write, mock_redis_queue, mock_init_add,
+                                        mock_setup_init_items):
+        codec = meesee.get_serializer('ndarray')
+        vectors = [numpy.full(4, i, dtype='float32') for i in range(3)]
+        mock_redis_queue.return_value.next_batch.side_effect = [(b'q', [codec.dumps(v) for v in vectors]), SystemExit()]
+        mock_func = MagicMock(__name__='test_func')
+
+        run_worker(mock_func, {}, None, {'key': 'test_queue', 'serializer': 'ndarray', 'max_batch': 3}, 1, {})
+
+        batch = mock_func.call_args[0][0]
+        self.assertEqual((batch.shape, batch.dtype), ((3, 4), numpy.float32))
+        numpy.testing.assert_array_equal(batch, numpy.stack(vectors))
+
+    @unittest.skipIf(numpy is None, "numpy is not installed")
+    def test_ndarray_codec(self):
+        codec = meesee.get_serializer('ndarray')
+        for sent in (numpy.arange(12, dtype='<f4').reshape(3, 4), numpy.arange(10)[::2], numpy.float64(1.5),
+                     numpy.zeros((0, 3)), numpy.arange(6, dtype='>i8').reshape(2, 3).T):
+            loaded = codec.loads(codec.dumps(sent))
+            self.assertEqual((loaded.dtype, loaded.shape), (sent.dtype, sent.shape))
+            numpy.testing.assert_array_equal(loaded, sent)
+            self.assertTrue(loaded.flags.writeable)
+        payload = codec.dumps(numpy.ones(3))
+        view = meesee.worker_loads({'serializer': 'ndarray', 'zero_copy': True})[0](payload)
+        self.assertFalse(view.flags.writeable)
+        self.assertTrue(view.flags.aligned)
+        with self.assertRaises(ValueError):
+            codec.dumps(numpy.array([{}, []], dtype=object))
+
+    def test_zero_copy_needs_ndarray(self):
+        with self.assertRaises(ValueError):
+            meesee.worker_loads({'serializer': 'json', 'zero_copy': True})
+
+    def test_expiry(self):
+        expiry = meesee.Expiry(batch_size=2)
+        old = meesee.Envelope.new(deadline=time.time() - 1).pack('old')
+        undated = meesee.Envelope.new().pack('undated')
+        self.assertEqual(expiry.live([old, b'plain', undated]), [b'plain', undated])
+        self.assertFalse(expiry.due(None))
+        self.assertIsNone(expiry.live([old]))
+        self.assertEqual(expiry.live(b'plain'), b'plain')
+        self.assertIsNone(expiry.live(old))
+        self.assertEqual((expiry.items, expiry.count), ([], 3))
+        self.assertTrue(expiry.due(None))
+        queue = MagicMock()
+        expiry.flush(queue)
+        queue.add_expired.assert_called_once_with([], 3)
+        self.assertFalse(expiry.due(b'plain'))
+
+    def test_envelope(self):
+        envelope = meesee.Envelope.new(attempts=3, deadline=2.5)
+        item = envelope.pack('payload')
+        self.assertEqual(len(item), meesee.Envelope.header.size + 7)
+        self.assertEqual(meesee.Envelope.unpack(item), (envelope, b'payload'))
+        self.assertEqual(meesee.Envelope.unpack(b'plain'), (None, b'plain'))
+        self.assertEqual(meesee.Envelope.unpack('{"json": 1}'.encode()), (None, b'{"json": 1}'))
+        unknown = item[:2] + b'\x09' + item[3:]
+        self.assertEqual(meesee.Envelope.unpack(unknown), (None, unknown))
+        self.assertEqual(meesee.open_item([item, b'plain']), ([b'payload', b'plain'], [envelope, None]))
+
+    @patch('meesee.redis.Redis')
+    def test_retry_envelope_queue(self, mock_redis):
+        queue = RedisQueue('test_namespace', 'test_key', {}, envelope=True)
+        policy = meesee.RetryPolicy(max_retries=3, dead_letter=True)
+        queue.send('item')
+        item = mock_redis.return_value.rpush.call_args[0][1]
+
+        for attempts in range(1, 4):
+            policy.failed(queue, item)
+            (member, _), = mock_redis.return_value.zadd.call_args[0][1].items()
+            item = member[16:]
+            envelope, payload = meesee.Envelope.unpack(item)
+            self.assertEqual((envelope.attempts, payload), (attempts, b'item'))
+
+        policy.failed(queue, item)
+        mock_redis.return_value.rpush.assert_called_with('test_namespace:test_key:dead', b'item')
+
+    def test_retry_policy(self):
+        policy = meesee.RetryPolicy(max_retries=5, backoff=1, max_backoff=10)
+        self.assertTrue(all(0 <= policy.delay(attempts) <= 10 for attempts in range(20)))
+        self.assertFalse(meesee.RetryPolicy().enabled)
+        with self.assertRaises(ValueError):
+            meesee.retry_policy({'backend': 'stream', 'dead_letter': True})
+
+    @patch('meesee.setup_init_items', return_value={})
+    @patch('meesee.init_add', return_value={})
+    @patch('meesee.RedisQueue')
+    @patch('sys.stdout.write')
+    def test_run_worker_threads(self, mock_stdout_write, mock_redis_queue, mock_init_add, mock_setup_init_items):
+        queue = mock_redis_queue.return_value
+        queue.__next__.side_effect = [(b'q', b'a'), (b'q', b'b'), (b'q', b'fail'), StopIteration]
+        handled, threads = [], set()
+        mock_on_failure_func = MagicMock()
+
+        def func(item, worker_id):
+            threads.add(meesee.threading.current_thread().name)
+            if item == 'fail':
+                raise Exception("Test exception")
+            handled.append(item)
+
+        config = {'key': 'test_queue', 'timeout': 1, 'threads_per_worker': 3}
+        run_worker(func, {}, mock_on_failure_func, config, 1, {})
+
+        self.assertEqual(sorted(handled), ['a', 'b'])
+        self.assertTrue(threads and all(name.startswith('worker-1-') for name in threads))
+        mock_on_failure_func.assert_called_once_with(b'fail', mock.ANY, queue, 1)
+        mock_redis_queue.assert_called_once_with(key='test_queue', timeout=1)
+        mock_stdout_write.assert_called_with('timeout reached worker 1 stopped\n')
+
+    @patch('meesee.setup_init_items', return_value={})
+    @patch('meesee.init_add', return_value={})
+    @patch('meesee.RedisQueue')
+    @patch('sys.stdout.write')
+    def test_run_worker_threads_empty_item(self, mock_stdout_write, mock_redis_queue, mock_init_add,
+                                           mock_setup_init_items):
+        queue = mock_redis_queue.return_value
+        queue.__next__.side_effect = [(b'q', b'a'), (b'q', b''), (b'q', b'b'), StopIteration]
+        handled = []
+
+        config = {'key': 'test_queue', 'timeout': 1, 'threads_per_worker': 2}
+        run_worker(lambda item, worker_id: handled.append(item), {}, None, config, 1, {})
+
+        self.assertEqual(sorted(handled), ['', 'a', 'b'])
+
+    @patch('meesee.setup_init_items', return_value={})
+    @patch('meesee.init_add', return_value={})
+    @patch('meesee.RedisQueue')
+    @patch('sys.stdout.write')
+    def test_run_worker_threads_failing_failure_path(self, mock_stdout_write, mock_redis_queue, mock_init_add,
+                                                     mock_setup_init_items):
+        queue = mock_redis_queue.return_value
+        queue.__next__.side_effect = [(b'q', b'a'), (b'q', b'b'), (b'q', b'c'), StopIteration]
+        queue.ack.side_effect = [meesee.redis.ConnectionError('ack failed'), None, None]
+        on_failure = MagicMock(side_effect=ValueError('handler failed'))
+
+        def func(item, worker_id):
+            raise Exception("Test exception")
+
+        config = {'key': 'test_queue', 'timeout': 1, 'threads_per_worker': 2, 'reliable': True}
+        run_worker(func, {}, on_failure, config, 1, {})
+
+        self.assertEqual(on_failure.call_count, 3)
+        self.assertEqual(queue.ack.call_count, 3)
+        mock_stdout_write.assert_any_call('worker 1 failure handler failed reason handler failed\n')
+        mock_stdout_write.assert_any_call('worker 1 failed reason ack failed\n')
+        mock_stdout_write.assert_called_with('timeout reached worker 1 stopped\n')
+
+    @patch('meesee.setup_init_items', return_value={})
+    @patch('meesee.init_add', return_value={})
+    @patch('meesee.RedisQueue')
+    @patch('sys.stdout.write')
+    def test_run_worker_threads_interrupt(self, mock_stdout_write, mock_redis_queue, mock_init_add, mock_setup_init_items):
+        queue = mock_redis_queue.return_value
+        release = meesee.threading.Event()
+        queue.__next__.side_effect = [(b'q', b'a'), (b'q', b'b'), KeyboardInterrupt]
+
+        config = {'key': 'test_queue', 'threads_per_worker': 3, 'batch_size': 3}
+        run_worker(lambda item, worker_id: release.wait(), {}, None, config, 1, {})
+        release.set()
+
+        mock_stdout_write.assert_any_call('worker 1 stopped\n')
+        queue.push_back.assert_called_once_with([(b'q', b'a'), (b'q', b'b')])
+
+    @patch('meesee.setup_init_items', return_value={})
+    @patch('meesee.init_add', return_value={})
+    @patch('meesee.RedisQueue')
+    @patch('sys.stdout.write')
+    def test_run_worker_max_tasks(self, mock_stdout_write, mock_redis_queue, mock_init_add, mock_setup_init_items):
+        mock_redis_queue.return_value.__iter__.return_value = iter([(b'q', b'a'), (b'q', b'b'), (b'q', b'c')])
+        mock_func = MagicMock(__name__='test_func')
+
+        config = {'key': 'test_queue', 'max_tasks_per_worker': 2}
+        self.assertTrue(run_worker(mock_func, {}, None, config, 1, {}))
+
+        self.assertEqual(mock_func.call_args_list, [call('a', 1), call('b', 1)])
+        mock_redis_queue.assert_called_once_with(key='test_queue')
+        self.assertTrue(mock_stdout_write.call_args_list[-1][0][0].startswith('worker 1 recycled after 2 tasks'))
+
+    @patch('meesee.rss_mb', side_effect=[100, 300])
+    @patch('meesee.setup_init_items', return_value={})
+    @patch('meesee.init_add', return_value={})
+    @patch('meesee.RedisQueue')
+    @patch('sys.stdout.write')
+    def test_run_worker_max_rss(self, mock_stdout_write, mock_redis_queue, mock_init_add, mock_setup_init_items, mock_rss):
+        queue = mock_redis_queue.return_value
+        queue.__iter__.return_value = iter([(b'q', b'a'), (b'q', b'b'), (b'q', b'c')])
+        queue.buffer = [(b'q', b'c')]
+
+        config = {'key': 'test_queue', 'max_rss_mb': 256, 'batch_size': 10}
+        self.assertTrue(run_worker(MagicMock(__name__='test_func'), {}, None, config, 1, {}))
+
+        queue.report_rss.assert_has_calls([call(100), call(None)])
+        queue.push_back.assert_called_once_with()
+        mock_stdout_write.assert_called_with('worker 1 recycled after 2 tasks, rss 300 MB\n')
+
+    @patch('meesee.resource', None)
+    @patch('builtins.open', side_effect=FileNotFoundError)
+    def test_rss_mb_without_procfs_and_resource(self, mock_open):
+        self.assertEqual(meesee.rss_mb(), 0.0)
 
 
 class TestRedisQueueCoverage(unittest.TestCase):
@@ -321,16 +1065,175 @@ class TestRedisQueueCoverage(unittest.TestCase):
         self.queue.send_to('other_key', 'item')
         self.mock_redis.rpush.assert_called_once_with('test_namespace:other_key', 'item')
 
-    def test_send(self):
+    @patch('meesee.redis.Redis')
+    def test_send_envelope(self, mock_redis):
+        queue = RedisQueue('test_namespace', 'test_key', {}, envelope=True)
+        queue.send('item')
+        queue.send_many(['a', 'b'])
+
+        envelope, payload = meesee.Envelope.unpack(mock_redis.return_value.rpush.call_args[0][1])
+        self.assertEqual((envelope.attempts, payload), (0, b'item'))
+        pipe = mock_redis.return_value.pipeline.return_value.__enter__.return_value
+        self.assertEqual([meesee.Envelope.unpack(i)[1] for i in pipe.rpush.call_args[0][1:]], [b'a', b'b'])
+
+    def test_send_bytes_like(self):
+        data = bytearray(b'\x00' * 16)
+        self.queue.send_to('other_key', data)
+        self.queue.send_to('other_key', memoryview(data)[:8])
+
+        sent = [c[0][1] for c in self.mock_redis.rpush.call_args_list]
+        self.assertIsInstance(sent[0], memoryview)
+        self.assertIs(sent[0].obj, data)
+        self.assertEqual(bytes(sent[1]), b'\x00' * 8)
+        self.assertEqual(meesee.as_buffer(memoryview(array.array('i', [1]))).nbytes, 4)
+        envelope, payload = meesee.Envelope.unpack(meesee.Envelope.new().pack(memoryview(b'abc')))
+        self.assertEqual(payload, b'abc')
+
+    @patch('meesee.redis.Redis')
+    def test_send_compressed(self, mock_redis):
+        queue = RedisQueue('test_namespace', 'test_key', {}, compression='zlib', compress_threshold=100)
+        document = json.dumps([{"id": i, "name": "item"} for i in range(100)])
+        queue.send(document)
+        queue.send('small')
+
+        sent, small = [c[0][1] for c in mock_redis.return_value.rpush.call_args_list]
+        self.assertLess(len(sent), len(document) / 4)
+        self.assertEqual(small, 'small')
+        self.assertEqual(meesee.open_item(sent), (document.encode(), meesee.Envelope.unpack(sent)[0]))
+        dead = meesee.strip_envelope(*meesee.Envelope.unpack(sent))
+        self.assertEqual(meesee.open_item(dead)[0], document.encode())
+        with self.assertRaises(ValueError):
+            RedisQueue('test_namespace', 'test_key', {}, compression='brotli')
+
+    @patch('meesee.redis.Redis')
+    def test_send_offloaded(self, mock_redis):
+        queue = RedisQueue('test_namespace', 'test_key', {}, offload='redis', offload_threshold=100, offload_ttl=60)
+        queue.send(b'x' * 100)
+
+        envelope, reference = meesee.Envelope.unpack(mock_redis.return_value.rpush.call_args[0][1])
+        key = 'test_namespace:blob:{}'.format(envelope.id.hex())
+        self.assertEqual(reference, b'')
+        self.assertEqual(envelope.flags, meesee.OFFLOAD_REDIS)
+        mock_redis.return_value.set.assert_called_once_with(key, b'x' * 100, ex=60)
+        mock_redis.return_value.get.return_value = b'x' * 100
+        self.assertEqual(queue.claim(envelope, reference), b'x' * 100)
+        mock_redis.return_value.get.assert_called_once_with(key)
+
+    def test_send_spooled(self):
+        with tempfile.TemporaryDirectory() as spool_dir:
+            queue = RedisQueue('test_namespace', 'test_key', {}, offload='spool', offload_threshold=4,
+                               spool_dir=spool_dir)
+            item = queue.wrap('payload')
+
+            self.assertEqual(meesee.open_item(item, queue), (b'payload', meesee.Envelope.unpack(item)[0]))
+            queue.release(item)
+            self.assertEqual(os.listdir(spool_dir), [])
+
+            with tempfile.NamedTemporaryFile() as victim:
+                forged = meesee.Envelope.new(flags=meesee.OFFLOAD_SPOOL).pack(victim.name)
+                with self.assertRaises(ValueError):
+                    meesee.open_item(forged, queue)
+                queue.release(forged)
+                self.assertTrue(os.path.exists(victim.name))
+
+    def test_spool_freed_when_dropped(self):
+        with tempfile.TemporaryDirectory() as spool_dir:
+            queue = RedisQueue('test_namespace', 'test_key', {}, offload='spool', offload_threshold=4,
+                               offload_ttl=60, spool_dir=spool_dir)
+            item = queue.wrap('payload')
+            meesee.RetryPolicy().failed(queue, item)
+            self.assertEqual(os.listdir(spool_dir), [])
+
+            queue.r = MagicMock()
+            retried = queue.wrap('retried')
+            meesee.RetryPolicy(max_retries=1).failed(queue, [retried])
+            (member, _), = queue.r.zadd.call_args[0][1].items()
+            meesee.RetryPolicy(max_retries=1).failed(queue, [member[16:]])
+            self.assertEqual(os.listdir(spool_dir), [])
+
+            evicted = queue.wrap('evicted')
+            path = queue.format_spool_path(meesee.Envelope.unpack(evicted)[0].id)
+            os.utime(path, (time.time() - 120, time.time() - 120))
+            queue.next_sweep = 0
+            queue.wrap('payload')
+            self.assertEqual(len(os.listdir(spool_dir)), 1)
+            self.assertFalse(os.path.exists(path))
+
+    def test_requeue_dead(self):
+        pipe = self.mock_redis.pipeline.return_value.__enter__.return_value
+        pipe.execute.side_effect = [[b'a', b'b'], [b'c', None]]
         self.mock_redis.llen.return_value = 5
+
+        self.assertEqual(self.queue.requeue_dead(chunk_size=2), 3)
+        self.mock_redis.llen.assert_called_once_with('test_namespace:test_key:dead')
+        pipe.lmove.assert_called_with('test_namespace:test_key:dead', self.queue.list_key, 'LEFT', 'RIGHT')
+        self.assertEqual(pipe.lmove.call_count, 4)
+
+    def test_report_rss(self):
+        self.queue.report_rss(123.45)
+        self.mock_redis.hset.assert_called_once_with('test_namespace:test_key:rss', self.queue.consumer, 123.5)
+        self.queue.report_rss(None)
+        self.mock_redis.hdel.assert_called_once_with('test_namespace:test_key:rss', self.queue.consumer)
+
+    def test_send(self):
+        self.queue.send('item')
+        self.mock_redis.register_script.return_value.assert_called_once_with(
+            keys=[self.queue.list_key], args=[10, 'item'])
+        self.mock_redis.llen.assert_not_called()
+        self.mock_redis.lpop.assert_not_called()
+        self.mock_redis.rpush.assert_not_called()
+
+    def test_send_unbounded(self):
+        self.queue.maxsize = None
         self.queue.send('item')
         self.mock_redis.rpush.assert_called_once_with(self.queue.list_key, 'item')
+        self.mock_redis.register_script.return_value.assert_not_called()
 
-    def test_send_maxsize_reached(self):
-        self.mock_redis.llen.return_value = 10
+    def test_send_infinite_maxsize(self):
+        self.queue.maxsize = float('inf')
         self.queue.send('item')
-        self.mock_redis.lpop.assert_called_once_with(self.queue.list_key)
         self.mock_redis.rpush.assert_called_once_with(self.queue.list_key, 'item')
+        self.mock_redis.register_script.return_value.assert_not_called()
+
+    def test_send_many(self):
+        pipe = self.mock_redis.pipeline.return_value.__enter__.return_value
+        sent = self.queue.send_many(iter(['a', 'b', 'c']), chunk_size=2)
+        self.assertEqual(sent, 3)
+        script = self.mock_redis.register_script.return_value
+        script.assert_has_calls([
+            call(keys=[self.queue.list_key], args=[10, 'a', 'b'], client=pipe),
+            call(keys=[self.queue.list_key], args=[10, 'c'], client=pipe),
+        ])
+        pipe.execute.assert_called_once()
+
+    def test_send_many_unbounded(self):
+        self.queue.maxsize = None
+        pipe = self.mock_redis.pipeline.return_value.__enter__.return_value
+        sent = self.queue.send_many(range(5), chunk_size=2, pipeline_chunks=2)
+        self.assertEqual(sent, 5)
+        pipe.rpush.assert_has_calls([
+            call(self.queue.list_key, 0, 1),
+            call(self.queue.list_key, 2, 3),
+            call(self.queue.list_key, 4),
+        ])
+        self.assertEqual(pipe.execute.call_count, 2)
+
+    def test_send_many_failing_generator(self):
+        self.queue.maxsize = None
+        pipe = self.mock_redis.pipeline.return_value.__enter__.return_value
+
+        def items():
+            yield from range(5)
+            raise ValueError("produce failed")
+
+        with self.assertRaises(ValueError):
+            self.queue.send_many(items(), chunk_size=2)
+        pipe.rpush.assert_has_calls([
+            call(self.queue.list_key, 0, 1),
+            call(self.queue.list_key, 2, 3),
+            call(self.queue.list_key, 4),
+        ])
+        pipe.execute.assert_called_once_with()
 
     def test_send_unsafe(self):
         self.queue.send_unsafe('item')
@@ -345,7 +1248,8 @@ class TestRedisQueueCoverage(unittest.TestCase):
 
     def test_send_dict(self):
         self.queue.send_dict({'key': 'value'})
-        self.mock_redis.rpush.assert_called_once_with(self.queue.list_key, json.dumps({'key': 'value'}))
+        self.mock_redis.register_script.return_value.assert_called_once_with(
+            keys=[self.queue.list_key], args=[10, json.dumps({'key': 'value'})])
 
     def test_iter(self):
         self.assertIsInstance(iter(self.queue), RedisQueue)
@@ -359,11 +1263,495 @@ class TestRedisQueueCoverage(unittest.TestCase):
         with self.assertRaises(StopIteration):
             next(self.queue)
 
+    def test_first_inline_send_many(self):
+        self.queue.first_inline_send('a', 'b', 'c')
+        self.mock_redis.lpush.assert_called_once_with(self.queue.list_key, 'c', 'b', 'a')
+
+    def test_next_batch(self):
+        self.queue.batch_size = 3
+        pipe = self.mock_redis.pipeline.return_value.__enter__.return_value
+        pipe.execute.return_value = [(b'key', b'a'), [b'b', b'c']]
+
+        self.assertEqual(next(self.queue), (b'key', b'a'))
+        self.assertEqual(next(self.queue), (b'key', b'b'))
+        pipe.blpop.assert_called_once_with([self.queue.list_key], 5)
+        pipe.lpop.assert_called_once_with(self.queue.list_key, 2)
+        self.assertEqual(self.queue.drain(), [b'c'])
+        self.assertEqual(len(self.queue.buffer), 0)
+
+    def test_next_batch_stop_iteration(self):
+        self.queue.batch_size = 3
+        pipe = self.mock_redis.pipeline.return_value.__enter__.return_value
+        pipe.execute.return_value = [None, None]
+        with self.assertRaises(StopIteration):
+            next(self.queue)
+
+    @patch('time.monotonic')
+    def test_get_batch(self, mock_monotonic):
+        mock_monotonic.side_effect = [0, 0, 0.0095]
+        pipe = self.mock_redis.pipeline.return_value.__enter__.return_value
+        pipe.execute.side_effect = [
+            [(b'key', b'a'), [b'b']],
+            [(b'key', b'c'), None],
+        ]
+
+        self.assertEqual(self.queue.get_batch(5, max_wait_ms=10), [b'a', b'b', b'c'])
+        # The batch fills up from the key its first item was taken from.
+        pipe.lpop.assert_has_calls([call(self.queue.list_key, 4), call(b'key', 2)])
+        pipe.blpop.assert_has_calls([call([self.queue.list_key], 5), call([b'key'], 0.01)])
+
+    @patch('time.monotonic', return_value=0)
+    def test_get_batch_interrupted(self, mock_monotonic):
+        pipe = self.mock_redis.pipeline.return_value.__enter__.return_value
+        pipe.execute.side_effect = [[(b'key', b'a'), [b'b']], KeyboardInterrupt()]
+
+        with self.assertRaises(KeyboardInterrupt):
+            self.queue.get_batch(5, max_wait_ms=10)
+        self.assertEqual(self.queue.drain(), [b'a', b'b'])
+
+    def test_get_batch_timeout(self):
+        pipe = self.mock_redis.pipeline.return_value.__enter__.return_value
+        pipe.execute.return_value = [None, None]
+        self.assertEqual(self.queue.get_batch(5, max_wait_ms=10), [])
+
+    def test_next_reliable(self):
+        self.queue.reliable = True
+        self.queue.next_reap = float('inf')
+        pipe = self.mock_redis.pipeline.return_value.__enter__.return_value
+        pipe.execute.return_value = [1, True, b'item']
+
+        self.assertEqual(next(self.queue), (self.queue.list_key, b'item'))
+        processing_key = self.queue.format_processing_key(self.queue.consumer)
+        pipe.sadd.assert_called_once_with(self.queue.format_consumers_key(), self.queue.consumer)
+        pipe.set.assert_called_once_with(self.queue.format_heartbeat_key(self.queue.consumer), 1, ex=60)
+        pipe.blmove.assert_called_once_with(self.queue.list_key, processing_key, mock.ANY, 'LEFT', 'RIGHT')
+        self.assertAlmostEqual(pipe.blmove.call_args[0][2], 5, places=2)
+
+        self.queue.ack(b'item')
+        self.mock_redis.lrem.assert_called_once_with(processing_key, 1, b'item')
+
+    def test_next_reliable_batch(self):
+        self.queue.reliable = True
+        self.queue.batch_size = 3
+        self.queue.next_reap = float('inf')
+        pipe = self.mock_redis.pipeline.return_value.__enter__.return_value
+        pipe.execute.return_value = [1, True, b'a', b'b', None]
+
+        self.assertEqual(next(self.queue), (self.queue.list_key, b'a'))
+        self.assertEqual(next(self.queue), (self.queue.list_key, b'b'))
+        processing_key = self.queue.format_processing_key(self.queue.consumer)
+        pipe.blmove.assert_called_once_with(self.queue.list_key, processing_key, mock.ANY, 'LEFT', 'RIGHT')
+        pipe.lmove.assert_has_calls([call(self.queue.list_key, processing_key, 'LEFT', 'RIGHT')] * 2)
+        self.assertEqual(pipe.execute.call_count, 1)
+
+    @patch('time.monotonic')
+    def test_get_batch_reliable(self, mock_monotonic):
+        mock_monotonic.side_effect = [0, 0, 0, 0.002, 0.002, 0.002, 0.011]
+        self.queue.reliable = True
+        self.queue.next_reap = float('inf')
+        pipe = self.mock_redis.pipeline.return_value.__enter__.return_value
+        pipe.execute.side_effect = [[1, True, b'a', b'b', None, None], [1, True, b'c', None]]
+
+        self.assertEqual(self.queue.get_batch(4, max_wait_ms=10), [b'a', b'b', b'c'])
+        processing_key = self.queue.format_processing_key(self.queue.consumer)
+        self.assertEqual(pipe.lmove.call_count, 4)
+        self.assertAlmostEqual(pipe.blmove.call_args_list[1][0][2], 0.008)
+        pipe.blpop.assert_not_called()
+
+        pipe.execute.side_effect = None
+        self.queue.ack([b'a', b'b', b'c'])
+        pipe.lrem.assert_has_calls([call(processing_key, 1, b'a'), call(processing_key, 1, b'b'),
+                                    call(processing_key, 1, b'c')])
+
+    def test_reap(self):
+        self.mock_redis.smembers.return_value = {b'host:1'}
+        pipe = self.mock_redis.pipeline.return_value.__enter__.return_value
+        pipe.execute.return_value = [3]
+
+        self.assertEqual(self.queue.reap(), 3)
+        self.mock_redis.smembers.assert_called_once_with(self.queue.format_consumers_key())
+        self.mock_redis.scan_iter.assert_not_called()
+        self.mock_redis.register_script.return_value.assert_called_once_with(keys=[
+            self.queue.format_processing_key('host:1'),
+            self.queue.list_key,
+            self.queue.format_heartbeat_key('host:1'),
+            self.queue.format_consumers_key(),
+        ], args=['host:1'], client=pipe)
+
+    def test_reap_nothing_to_do(self):
+        self.mock_redis.smembers.return_value = set()
+        self.assertEqual(self.queue.reap(), 0)
+        self.mock_redis.pipeline.assert_not_called()
+
+    @patch('os.urandom', return_value=b'\x00' * 8)
+    def test_send_at(self, mock_urandom):
+        self.queue.send_at('item', 100)
+        self.mock_redis.zadd.assert_called_once_with(
+            'test_namespace:test_key:delayed', {b'0000000000000000item': 100})
+
+    @patch('time.time', return_value=50)
+    def test_send_in(self, mock_time):
+        self.queue.send_in(1, 10)
+        (key, mapping), _ = self.mock_redis.zadd.call_args
+        self.assertEqual(key, 'test_namespace:test_key:delayed')
+        self.assertEqual(list(mapping.values()), [60])
+        self.assertTrue(list(mapping)[0].endswith(b'1'))
+
+    @patch('time.time', return_value=50)
+    def test_next_promotes_due_items(self, mock_time):
+        self.queue.promote_interval = 1
+        self.queue.promote_batch = 2
+        pipe = self.mock_redis.pipeline.return_value.__enter__.return_value
+        pipe.execute.return_value = [2, (b'key', b'a')]
+        script = self.mock_redis.register_script.return_value
+
+        self.assertEqual(next(self.queue), (b'key', b'a'))
+        script.assert_called_once_with(
+            keys=['test_namespace:test_key:delayed', self.queue.list_key], args=[50, 2], client=pipe)
+        # A full batch was promoted, the next fetch promotes again.
+        self.assertTrue(self.queue.add_promote(pipe))
+
+    def test_next_promote_waits_for_interval(self):
+        self.queue.promote_interval = 1
+        pipe = self.mock_redis.pipeline.return_value.__enter__.return_value
+        pipe.execute.return_value = [0, (b'key', b'a')]
+        next(self.queue)
+        self.assertFalse(self.queue.add_promote(pipe))
+
+    @patch('meesee.redis.Redis')
+    def test_priority_keys(self, mock_redis):
+        queue = RedisQueue('ns', ['urgent', 'normal', 'bulk'], {}, timeout=5)
+        self.assertEqual(queue.list_key, 'ns:urgent')
+        mock_redis.return_value.blpop.return_value = (b'ns:normal', b'item')
+
+        self.assertEqual(next(queue), (b'ns:normal', b'item'))
+        mock_redis.return_value.blpop.assert_called_once_with(['ns:urgent', 'ns:normal', 'ns:bulk'], 5)
+
+    @patch('meesee.redis.Redis')
+    def test_priority_keys_batch(self, mock_redis):
+        queue = RedisQueue('ns', ['urgent', 'normal'], {}, timeout=5, batch_size=10)
+        pipe = mock_redis.return_value.pipeline.return_value.__enter__.return_value
+        pipe.execute.return_value = [[b'ns:normal', [b'a', b'b']]]
+
+        self.assertEqual(next(queue), (b'ns:normal', b'a'))
+        self.assertEqual(queue.drain(), [b'b'])
+        pipe.blmpop.assert_called_once_with(5, 2, 'ns:urgent', 'ns:normal', direction='LEFT', count=10)
+
+    @patch('meesee.redis.Redis')
+    def test_priority_keys_push_back(self, mock_redis):
+        queue = RedisQueue('ns', ['urgent', 'normal'], {})
+        pipe = mock_redis.return_value.pipeline.return_value.__enter__.return_value
+        queue.buffer.extend([(b'ns:normal', b'c'), (b'ns:urgent', b'd')])
+
+        self.assertEqual(queue.push_back([(b'ns:normal', b'a'), (b'ns:normal', b'b')]), 4)
+        pipe.lpush.assert_has_calls([call('ns:normal', b'c', b'b', b'a'), call('ns:urgent', b'd')])
+        self.assertEqual(len(queue.buffer), 0)
+
+    @patch('time.time', return_value=50)
+    @patch('meesee.redis.Redis')
+    def test_priority_keys_retry(self, mock_redis, mock_time):
+        queue = RedisQueue('ns', ['urgent', 'normal'], {}, promote_interval=1)
+        client = mock_redis.return_value
+        pipe = client.pipeline.return_value.__enter__.return_value
+        retried = meesee.Envelope.new(attempts=1).pack('retried')
+        meesee.RetryPolicy(max_retries=1, dead_letter=True).failed(queue, [b'a', retried], key=b'ns:normal')
+
+        self.assertEqual(client.zadd.call_args[0][0], 'ns:normal:delayed')
+        client.rpush.assert_called_once_with('ns:normal:dead', b'retried')
+
+        pipe.execute.return_value = [0, 0, (b'ns:normal', b'a')]
+        next(queue)
+        client.register_script.return_value.assert_has_calls([
+            call(keys=['ns:urgent:delayed', 'ns:urgent'], args=[50, 1000], client=pipe),
+            call(keys=['ns:normal:delayed', 'ns:normal'], args=[50, 1000], client=pipe),
+        ])
+
+    @patch('meesee.redis.Redis')
+    def test_priority_keys_next_batch(self, mock_redis):
+        queue = RedisQueue('ns', ['urgent', 'normal'], {}, timeout=5)
+        pipe = mock_redis.return_value.pipeline.return_value.__enter__.return_value
+        pipe.execute.side_effect = [[[b'ns:normal', [b'a']]], [(b'ns:normal', b'b'), None], [None, None]]
+
+        self.assertEqual(queue.next_batch(3, max_wait_ms=1000), (b'ns:normal', [b'a', b'b']))
+        # The batch fills up from ns:normal only.
+        pipe.blpop.assert_has_calls([call([b'ns:normal'], mock.ANY)] * 2)
+        pipe.blmpop.assert_called_once_with(5, 2, 'ns:urgent', 'ns:normal', direction='LEFT', count=3)
+
+    @patch('random.choices', return_value=[2])
+    @patch('meesee.redis.Redis')
+    def test_priority_weights(self, mock_redis, mock_choices):
+        queue = RedisQueue('ns', ['urgent', 'normal', 'bulk'], {}, weights=[8, 3, 1])
+        self.assertEqual(queue.ordered_keys(), ['ns:bulk', 'ns:urgent', 'ns:normal'])
+        mock_choices.assert_called_once_with(range(3), weights=[8, 3, 1])
+
+    @patch('meesee.redis.Redis')
+    def test_priority_keys_reliable(self, mock_redis):
+        with self.assertRaises(ValueError):
+            RedisQueue('ns', ['urgent', 'normal'], {}, reliable=True)
+
     def test_len(self):
         self.mock_redis.llen.return_value = 5
         self.assertEqual(len(self.queue), 5)
 
 
+class TestBatchWorkerDecorator(unittest.TestCase):
+    def setUp(self):
+        self.box = Meesee(workers=2, namespace="test", timeout=2)
+
+    @patch('meesee.startapp')
+    def test_batch_worker_config(self, mock_startapp):
+        @self.box.batch_worker(queue="rows", max_batch=500, max_wait_ms=20)
+        def insert_rows(items, worker_id):
+            pass
+
+        self.box.push_button()
+
+        self.assertIs(self.box._worker_funcs["rows"], insert_rows)
+        configs = mock_startapp.call_args[1]["config"]
+        self.assertEqual(configs, [{
+            "key": "rows",
+            "namespace": "test",
+            "redis_config": {},
+            "max_batch": 500,
+            "max_wait_ms": 20,
+            "timeout": 2,
+        }])
+
+
+class TestWorkerOptions(unittest.TestCase):
+    def setUp(self):
+        self.box = Meesee(workers=2, namespace="test")
+
+    @patch('meesee.startapp')
+    @patch('meesee.StreamQueue')
+    @patch('meesee.RedisQueue')
+    def test_worker_backend_option(self, mock_redis_queue, mock_stream_queue, mock_startapp):
+        @self.box.worker(backend="stream")
+        def events(item, worker_id):
+            pass
+
+        @self.box.produce_to()
+        def produce_multi(items):
+            return items
+
+        produce_multi([("events", "item1"), ("other", "item2")])
+        mock_stream_queue.assert_called_once_with(key="events", namespace="test", redis_config={})
+        mock_stream_queue.return_value.send.assert_called_once_with("item1")
+        mock_redis_queue.return_value.send_to.assert_called_once_with("other", "item2")
+
+        self.box.push_button()
+        configs = mock_startapp.call_args[1]["config"]
+        self.assertEqual(configs[0]["backend"], "stream")
+
+    @patch('meesee.startapp')
+    def test_worker_priority_queues(self, mock_startapp):
+        @self.box.worker(queue=["urgent", "normal"], weights=[3, 1])
+        def handle(item, worker_id):
+            pass
+
+        self.box.push_button()
+        self.assertIs(self.box._worker_funcs[("urgent", "normal")], handle)
+        configs = mock_startapp.call_args[1]["config"]
+        self.assertEqual(configs[0]["key"], ("urgent", "normal"))
+        self.assertEqual(configs[0]["weights"], [3, 1])
+
+
+class TestProduceDecorator(unittest.TestCase):
+    def setUp(self):
+        self.box = Meesee(workers=5, namespace="test", timeout=2)
+
+    @patch('meesee.RedisQueue')
+    def test_produce_sends_in_bulk(self, mock_redis_queue):
+        @self.box.produce(queue="foo")
+        def produce_items():
+            yield "item1"
+            yield {"key": "item2"}
+
+        produce_items()
+
+        mock_redis_queue.return_value.send.assert_not_called()
+        sent = mock_redis_queue.return_value.send_many.call_args[0][0]
+        self.assertEqual(list(sent), ["item1", json.dumps({"key": "item2"})])
+        self.assertEqual(mock_redis_queue.return_value.send_many.call_args[1], {"pipeline_chunks": 1})
+
+    @patch('meesee.RedisQueue')
+    def test_produce_with_serializer(self, mock_redis_queue):
+        @self.box.worker(queue="objects", serializer="pickle")
+        def handle(item, worker_id):
+            pass
+
+        @self.box.produce(queue="objects")
+        def produce_items():
+            yield ("a", 1)
+            yield "item"
+
+        produce_items()
+
+        sent = mock_redis_queue.return_value.send_many.call_args[0][0]
+        self.assertEqual([pickle.loads(item) for item in sent], [("a", 1), "item"])
+        self.assertEqual(mock_redis_queue.call_args[1]["serializer"], "pickle")
+
+    def test_get_serializer(self):
+        self.assertIs(meesee.get_serializer(), meesee.TEXT)
+        self.assertEqual(meesee.TEXT.dumps({"a": 1}), '{"a": 1}')
+        self.assertEqual(meesee.TEXT.loads(b'text'), 'text')
+        self.assertEqual(meesee.get_serializer("json").loads(b'{"a": [1]}'), {"a": [1]})
+        custom = meesee.Serializer(str, int)
+        self.assertIs(meesee.get_serializer(custom), custom)
+        with self.assertRaises(ValueError):
+            meesee.get_serializer("yaml")
+
+
+class TestStreamQueue(unittest.TestCase):
+
+    @patch('meesee.redis.Redis')
+    def setUp(self, mock_redis):
+        self.mock_redis = mock_redis.return_value
+        self.pipe = self.mock_redis.pipeline.return_value.__enter__.return_value
+        self.queue = StreamQueue('test_namespace', 'test_key', {}, maxsize=10, timeout=5, batch_size=2, ack_batch=2)
+        self.queue.group_ready = True
+
+    def test_send(self):
+        self.queue.send('item')
+        self.mock_redis.xadd.assert_called_once_with(
+            'test_namespace:test_key', {'item': 'item'}, maxlen=10, approximate=True)
+
+    def test_send_unbounded(self):
+        self.queue.maxsize = None
+        self.queue.send_to('other', 'item')
+        self.mock_redis.xadd.assert_called_once_with('test_namespace:other', {'item': 'item'})
+
+    @patch('time.monotonic', return_value=0)
+    def test_next_batch(self, mock_monotonic):
+        self.queue.next_claim = float('inf')
+        self.pipe.execute.side_effect = [
+            [[[b'test_namespace:test_key', [(b'1-0', {b'item': b'a'}), (b'1-1', {b'item': b'old'})]]]],
+            [[[b'test_namespace:test_key', [(b'1-2', {b'item': b'b'})]]]],
+        ]
+
+        self.assertEqual(self.queue.next_batch(3, max_wait_ms=10), ('test_namespace:test_key', [b'a', b'old', b'b']))
+        self.pipe.xreadgroup.assert_has_calls([
+            call('meesee', self.queue.consumer, {'test_namespace:test_key': '>'}, count=3, block=5000),
+            call('meesee', self.queue.consumer, {'test_namespace:test_key': '>'}, count=1, block=10),
+        ])
+
+        self.queue.ack([b'old'])
+        self.queue.ack([b'a', b'b'])
+        self.mock_redis.xack.assert_has_calls([
+            call('test_namespace:test_key', 'meesee', b'1-1', b'1-0', b'1-2'),
+        ])
+        self.assertEqual(len(self.queue.delivered), 0)
+
+    def test_read_claims_and_reads(self):
+        self.pipe.execute.return_value = [
+            [b'0-0', [(b'1-0', {b'item': b'claimed'}), (b'1-1', None)]],
+            [[b'test_namespace:test_key', [(b'2-0', {b'item': b'new'})]]],
+        ]
+        self.assertEqual(next(self.queue), ('test_namespace:test_key', b'claimed'))
+        self.assertEqual(next(self.queue), ('test_namespace:test_key', b'new'))
+        self.pipe.xautoclaim.assert_called_once_with(
+            'test_namespace:test_key', 'meesee', self.queue.consumer, 60000, start_id='0-0', count=2)
+        self.pipe.xreadgroup.assert_called_once_with(
+            'meesee', self.queue.consumer, {'test_namespace:test_key': '>'}, count=2, block=None)
+
+    def test_read_claims_from_cursor(self):
+        self.pipe.execute.side_effect = [
+            [[b'5-0', []], []],
+            [[b'0-0', []], []],
+            [[[b'test_namespace:test_key', [(b'6-0', {b'item': b'new'})]]]],
+        ]
+        self.assertEqual(next(self.queue), ('test_namespace:test_key', b'new'))
+        self.pipe.xautoclaim.assert_has_calls([
+            call('test_namespace:test_key', 'meesee', self.queue.consumer, 60000, start_id='0-0', count=2),
+            call('test_namespace:test_key', 'meesee', self.queue.consumer, 60000, start_id=b'5-0', count=2),
+        ])
+        self.pipe.xreadgroup.assert_has_calls([
+            call('meesee', self.queue.consumer, {'test_namespace:test_key': '>'}, count=2, block=None),
+            call('meesee', self.queue.consumer, {'test_namespace:test_key': '>'}, count=2, block=None),
+            call('meesee', self.queue.consumer, {'test_namespace:test_key': '>'}, count=2, block=5000),
+        ])
+        self.assertEqual(self.queue.claim_cursor, '0-0')
+
+    def test_acks_are_batched(self):
+        self.queue.delivered.extend([(b'1-0', b'a'), (b'1-1', b'b')])
+        self.queue.ack(b'a')
+        self.mock_redis.xack.assert_not_called()
+        self.queue.ack(b'b')
+        self.mock_redis.xack.assert_called_once_with('test_namespace:test_key', 'meesee', b'1-0', b'1-1')
+
+    def test_acks_sent_with_next_read(self):
+        self.queue.next_claim = float('inf')
+        self.queue.ack_ids = [b'1-0']
+        self.pipe.execute.return_value = [1, []]
+        with self.assertRaises(StopIteration):
+            next(self.queue)
+        self.pipe.xack.assert_called_once_with('test_namespace:test_key', 'meesee', b'1-0')
+        self.assertEqual(self.queue.ack_ids, [])
+
+    def test_requeue_processing(self):
+        self.queue.delivered.append((b'1-0', b'a'))
+        self.queue.buffer.append((b'1-1', b'b'))
+        self.assertEqual(self.queue.requeue_processing(), 2)
+        self.pipe.xadd.assert_has_calls([
+            call('test_namespace:test_key', {'item': b'a'}, maxlen=10, approximate=True),
+            call('test_namespace:test_key', {'item': b'b'}, maxlen=10, approximate=True),
+        ])
+        self.mock_redis.xack.assert_called_once_with('test_namespace:test_key', 'meesee', b'1-0', b'1-1')
+
+    def test_first_inline_send_then_ack(self):
+        self.queue.delivered.extend([(b'1-0', b'a'), (b'1-1', b'b')])
+        self.queue.first_inline_send(b'a')
+        self.pipe.xadd.assert_called_once_with('test_namespace:test_key', {'item': b'a'}, maxlen=10, approximate=True)
+        self.pipe.xack.assert_not_called()
+        self.queue.ack(b'a')
+        self.queue.ack(b'b')
+        self.mock_redis.xack.assert_called_once_with('test_namespace:test_key', 'meesee', b'1-0', b'1-1')
+
+    def test_len_counts_lag_and_pending(self):
+        self.pipe.execute.return_value = [
+            [{'name': b'other', 'pending': 0, 'lag': 9}, {'name': b'meesee', 'pending': 2, 'lag': 3}], 100]
+        self.assertEqual(len(self.queue), 5)
+        self.pipe.xinfo_groups.assert_called_once_with('test_namespace:test_key')
+
+    def test_len_without_lag(self):
+        self.pipe.execute.return_value = [[{'name': b'meesee', 'pending': 2}], 100]
+        self.assertEqual(len(self.queue), 100)
+
+    @patch('meesee.StreamQueue')
+    @patch('meesee.RedisQueue')
+    def test_make_queue(self, mock_redis_queue, mock_stream_queue):
+        make_queue({'key': 'a', 'max_batch': 5})
+        mock_redis_queue.assert_called_once_with(key='a')
+        make_queue({'key': 'b', 'backend': 'stream'})
+        mock_stream_queue.assert_called_once_with(key='b')
+
+
+class TestConnectionPools(unittest.TestCase):
+    def setUp(self):
+        connection_pools.clear()
+
+    def tearDown(self):
+        connection_pools.clear()
+
+    def test_shared_pool_per_config(self):
+        pool = get_connection_pool({"host": "localhost", "port": 6379})
+        self.assertIs(get_connection_pool({"port": 6379, "host": "localhost"}), pool)
+        self.assertIsNot(get_connection_pool({"host": "localhost", "port": 6380}), pool)
+
+    @patch('meesee.redis.Redis')
+    def test_queues_share_pool(self, mock_redis):
+        RedisQueue('ns', 'a', {})
+        RedisQueue('ns', 'b', {})
+        pools = [kwargs["connection_pool"] for _, kwargs in mock_redis.call_args_list]
+        self.assertEqual(len(pools), 2)
+        self.assertIs(pools[0], pools[1])
+
+    def test_new_pool_after_fork(self):
+        pool = get_connection_pool({})
+        with patch('os.getpid', return_value=-1):
+            self.assertIsNot(get_connection_pool({}), pool)
+
+
 class TestProduceToDecorator(unittest.TestCase):
     def setUp(self):
         self.box = Meesee(workers=5, namespace="test", timeout=2)
@@ -437,5 +1825,148 @@ class TestProduceToDecorator(unittest.TestCase):
             self.assertEqual(result[0][1], item)
 
 
+class TestAsyncWorker(unittest.TestCase):
+
+    def setUp(self):
+        self.config = {'namespace': 'ns', 'key': 'q', 'redis_config': {}, 'concurrency': 2}
+
+    def fake_queue(self, mock_queue, items):
+        queue = mock_queue.return_value
+        items = iter(items)
+
+        async def get():
+            item = next(items, None)
+            if item == 'block':
+                await asyncio.sleep(10)
+            if isinstance(item, Exception):
+                raise item
+            return item
+
+        queue.get.side_effect = get
+        queue.push_back = AsyncMock()
+        queue.close = AsyncMock()
+        queue.buffer = []
+        return queue
+
+    @patch('meesee.AsyncRedisQueue')
+    @patch('sys.stdout.write')
+    def test_coroutine_function_runs_concurrently(self, mock_stdout_write, mock_queue):
+        queue = self.fake_queue(mock_queue, [(b'ns:q', b'a'), (b'ns:q', b'b'), (b'ns:q', b'fail'), None])
+        running, peak, handled = [], [], []
+        on_failure = AsyncMock()
+
+        async def func(item, worker_id):
+            running.append(item)
+            peak.append(len(running))
+            await asyncio.sleep(0.01)
+            running.remove(item)
+            if item == 'fail':
+                raise ValueError('fail')
+            handled.append(item)
+
+        run_worker(func, {}, on_failure, self.config, 1, {})
+
+        self.assertEqual(handled, ['a', 'b'])
+        self.assertEqual(max(peak), 2)
+        on_failure.assert_awaited_once_with(b'fail', mock.ANY, queue, 1)
+        mock_queue.assert_called_once_with(namespace='ns', key='q', redis_config={})
+        queue.push_back.assert_not_called()
+        queue.close.assert_awaited_once_with()
+        mock_stdout_write.assert_called_with('timeout reached worker 1 stopped\n')
+
+    @patch('meesee.AsyncRedisQueue')
+    @patch('sys.stdout.write')
+    def test_interrupt_pushes_back_in_flight(self, mock_stdout_write, mock_queue):
+        queue = self.fake_queue(mock_queue, [(b'ns:q', b'slow'), (b'ns:q', b'stop'), 'block'])
+        self.config['concurrency'] = 3
+
+        async def func(item, worker_id):
+            if item == 'stop':
+                raise KeyboardInterrupt()
+            await asyncio.sleep(10)
+
+        run_worker(func, {}, None, self.config, 1, {})
+
+        mock_stdout_write.assert_any_call('worker 1 stopped\n')
+        queue.push_back.assert_awaited_once_with([(b'ns:q', b'slow'), (b'ns:q', b'stop')])
+
+    @patch('meesee.RedisQueue')
+    @patch('meesee.AsyncRedisQueue')
+    @patch('sys.stdout.write')
+    def test_sync_failure_handler_gets_sync_queue(self, mock_stdout_write, mock_queue, mock_redis_queue):
+        self.fake_queue(mock_queue, [(b'ns:q', b'fail'), None])
+
+        def on_failure(item, e, r_instance, worker_id):
+            r_instance.send(item)
+
+        async def func(item, worker_id):
+            raise ValueError('fail')
+
+        run_worker(func, {}, on_failure, self.config, 1, {})
+
+        mock_redis_queue.assert_called_once_with(namespace='ns', key='q', redis_config={})
+        mock_redis_queue.return_value.send.assert_called_once_with(b'fail')
+
+    @patch('meesee.AsyncRedisQueue')
+    @patch('sys.stdout.write')
+    def test_reconnects_after_redis_error(self, mock_stdout_write, mock_queue):
+        queue = self.fake_queue(mock_queue, [ConnectionError('connection lost'), (b'ns:q', b'a'), None])
+        handled = []
+
+        async def func(item, worker_id):
+            handled.append(item)
+
+        run_worker(func, {}, None, {**self.config, 'concurrency': 1}, 1, {})
+
+        self.assertEqual(handled, ['a'])
+        self.assertEqual(queue.get.call_count, 3)
+        mock_stdout_write.assert_any_call('worker 1 failed reason connection lost\n')
+        mock_stdout_write.assert_called_with('timeout reached worker 1 stopped\n')
+
+    @patch('meesee.AsyncRedisQueue')
+    @patch('sys.stdout.write')
+    def test_task_timeout(self, mock_stdout_write, mock_queue):
+        self.fake_queue(mock_queue, [(b'ns:q', b'stuck'), (b'ns:q', b'fast'), None])
+        on_failure, handled = MagicMock(), []
+
+        async def func(item, worker_id):
+            if item == 'stuck':
+                await asyncio.sleep(5)
+            handled.append(item)
+
+        run_worker(func, {}, on_failure, {**self.config, 'task_timeout': 0.05}, 1, {})
+
+        self.assertEqual(handled, ['fast'])
+        self.assertIsInstance(on_failure.call_args[0][1], meesee.TaskTimeout)
+
+    @patch('meesee.AsyncRedisQueue')
+    @patch('sys.stdout.write')
+    def test_unsupported_options(self, mock_stdout_write, mock_queue):
+        async def func(item, worker_id):
+            pass
+
+        for option in ({'max_batch': 10, 'max_wait_ms': 5}, {'max_tasks_per_worker': 100}, {'max_rss_mb': 512}):
+            with self.assertRaises(ValueError):
+                run_worker(func, {}, None, {**self.config, **option}, 1, {})
+        mock_queue.assert_not_called()
+
+    def test_make_async_queue_unsupported(self):
+        with self.assertRaises(ValueError):
+            make_async_queue({**self.config, 'backend': 'stream'})
+        with self.assertRaises(ValueError):
+            make_async_queue({**self.config, 'reliable': True})
+
+    @patch('meesee.redis.asyncio.Redis')
+    def test_fetch_batch(self, mock_redis):
+        pipe = mock_redis.return_value.pipeline.return_value.__aenter__.return_value = MagicMock()
+        pipe.execute = AsyncMock(return_value=[(b'ns:q', b'a'), [b'b', b'c']])
+        queue = AsyncRedisQueue('ns', 'q', {}, timeout=1, batch_size=3)
+
+        self.assertEqual(asyncio.run(queue.get()), (b'ns:q', b'a'))
+        self.assertEqual(queue.drain(), [b'b', b'c'])
+        pipe.blpop.assert_called_once_with(['ns:q'], 1)
+        pipe.lpop.assert_called_once_with('ns:q', 2)
+
+
 if __name__ == '__main__':
     unittest.main()
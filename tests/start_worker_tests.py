@@ -42,6 +42,9 @@ class StubRedisQueue:
     def first_inline_send(self, item):
         self.items.append(item)
 
+    def push_back(self, pairs=()):
+        self.items.extend(item for _, item in pairs)
+
 
 class TestRunWorker(unittest.TestCase):
     def setUp(self):